@@ -1,53 +1,56 @@
 #!/usr/bin/env python3
 # Standard library modules.
-import io
 import os
 import sys
+import copy
 import json
 import time
 import signal
 import random
+import asyncio
+import threading
+import subprocess
 import logging
-import traceback
 from functools import wraps
 
 # Third party modules.
 import telegram
 from tabulate import tabulate
 from mosquito.utils import NameSpaceDict, SingletonContextABC
-from telegram.ext import Updater, CommandHandler, MessageHandler, Filters
+from telegram.ext import Updater, CommandHandler, MessageHandler, TypeHandler, Filters
 
 # Local modules
-from util import tts, timeout
-from challenge import Challenge
+import logs
+import media
+import executor
+from util import MAX_OUTPUT, KeyedLock, tts_cache, tts_renderer
+from cache import LRUCache
+from metrics import stats
+from profiling import profiler
+from webhook import WebhookServer
+from delivery import outbox
+from dispatch import AsyncDispatcher, offload
+from challenge import EXECUTION_TIMEOUT, Challenge, ChallengeMeta, extract_source, verdicts
+from sharding import Ingress, ShardClient, owner
+from submissions import SubmissionError, submissions
+from persistence import BACKENDS, SQLiteStore, UserStates, atomic_dump
 
 # Globals and constants variables.
-_FSTRING_LOG = '{asctime}  {threadName:<25}  {levelname:>8}:  {message}'
-_FSTRING_MSG = '{message}'
+log_handler = logs.setup(os.path.expanduser(os.environ.get('CONFIG_PATH', '~/.das_system')))
 
-_FORMATTER_LOG = logging.Formatter(_FSTRING_LOG, style='{')
-_FORMATTER_MSG = logging.Formatter(_FSTRING_MSG, style='{')
-
-_STDOUT_HANDLER = logging.StreamHandler(stream=sys.stdout)
-_STDOUT_HANDLER.setFormatter(_FORMATTER_LOG)
-
-_FILE_HANDLER_LOG = logging.FileHandler(os.path.expanduser('~/.das_system/log'), encoding='utf-8')
-_FILE_HANDLER_LOG.setFormatter(_FORMATTER_LOG)
-
-_FILE_HANDLER_MSG = logging.FileHandler(os.path.expanduser('~/.das_system/msg'), encoding='utf-8')
-_FILE_HANDLER_MSG.setFormatter(_FORMATTER_MSG)
+# records that didn't fit into the queue of the log writer
+stats.gauge('das_log_dropped_total', lambda: log_handler.dropped, kind='counter')
 
 system_log = logging.getLogger('das-system-log')
-system_log.addHandler(_STDOUT_HANDLER)
-system_log.addHandler(_FILE_HANDLER_LOG)
-
 system_msg = logging.getLogger('das-system-msg')
-system_msg.addHandler(_STDOUT_HANDLER)
-system_msg.addHandler(_FILE_HANDLER_LOG)
-system_msg.addHandler(_FILE_HANDLER_MSG)
 
-system_log.setLevel(logging.DEBUG)
-system_msg.setLevel(logging.DEBUG)
+# name of this process as worker of a sharded deployment, see `ingress`
+SHARD = os.environ.get('SHARD')
+
+# the open bot context, handlers use it without entering it, see `BotContext.__on_open__`
+_CONTEXT = None
+
+VOICE_REPLY = 'Joooo! Ich kann zwar reden, aber glaub bloß nicht, dass ich dir zuhöre.'
 
 # TODO update
 TEMPLATE_HELP = """
@@ -69,14 +72,18 @@ _Aktive Challenge:_ *{active}*
 """.strip()
 
 
-def forbidden(update, context):
-    system_msg.info(f'not authorized: {update.effective_user.name}')
+help_cache = LRUCache(256)
+
+
+async def forbidden(update, context):
+    system_msg.warning(f'not authorized: {update.effective_user.name}',
+                       extra=dict(user=update.effective_user.name, chat=update.effective_chat.id))
 
-    context.bot.send_message(
-        text=f'`{update.effective_user.name}: access denied`',
-        chat_id=update.effective_chat.id,
+    await asyncio.wrap_future(outbox.send_message(
+        context.bot, update.effective_chat.id,
+        f'`{update.effective_user.name}: access denied`',
         parse_mode=telegram.ParseMode.MARKDOWN
-    )
+    ))
 
 
 def initial_state():
@@ -88,67 +95,102 @@ def initial_state():
 
 def callback(func):
     @wraps(func)
-    def wrapper(update, context):
-        system_msg.info(f'callback: {update.effective_chat.id} ({update.effective_user.username}) --> {func.__name__}')
+    async def wrapper(update, context):
+        start = time.perf_counter()
+        record = dict(
+            user=update.effective_user.username,
+            chat=update.effective_chat.id,
+            command=func.__name__,
+        )
 
         try:
-            with BotContext() as bc:
-                if update.effective_user.name not in bc.config.telegram.allowed_users:
-                    return forbidden(update, context)
-    
-                if update.effective_user.username not in bc.state:
-                    bc.state[update.effective_user.username] = initial_state()
-
-                bc.config.telegram.chats = sorted(
-                    {*bc.config.telegram.chats, update.effective_chat.id}
-                )
-    
-                msg = func(update, context, bc.state[update.effective_user.username])
-
-                if msg is not None:
-                    context.bot.send_message(
-                        text=msg,
-                        chat_id=update.effective_chat.id,
-                        parse_mode=telegram.ParseMode.MARKDOWN
-                    )
-            
+            allowed = update.effective_user.name in _CONTEXT.config.telegram.allowed_users
+            states = _CONTEXT.states
+
+            if allowed and update.effective_chat.id not in _CONTEXT.chats:
+                with _CONTEXT.lock:
+                    _CONTEXT.chats.add(update.effective_chat.id)
+                    _CONTEXT.dirty.config = True
+
+            if not allowed:
+                stats.inc('das_commands_total', command=func.__name__, outcome='forbidden')
+                return await forbidden(update, context)
+
+            username = update.effective_user.username
+            chat_id = update.effective_chat.id
+
+            # updates of one user are processed one after another, different users never contend
+            async with states.locks[username]:
+                # loading and writing back states may hit the disk
+                state = await offload(states.get, username)
+                before = copy.deepcopy(state)
+
+                msg = await profiler.call(func.__name__, func, update, context, state)
+
+                if state != before:
+                    await offload(states.mark_dirty, username, state)
+
+            # messages sent by the handler itself are queued for the chat already, the reply
+            # follows them, possibly within the same message
+            if msg is not None:
+                await asyncio.wrap_future(outbox.send_message(
+                    context.bot, chat_id, msg, parse_mode=telegram.ParseMode.MARKDOWN
+                ))
+
         except Exception as error:
-            with io.StringIO() as buffer:
-                traceback.print_exception(type(error), error, error.__traceback__, file=buffer)
-                system_log.error(buffer.getvalue().replace('\n', '\\n'))
-
-            context.bot.send_message(
-                text='Ein interner Fehler ist aufgetreten, '
-                     'ich kann die Nachricht nicht verarbeiten! O.o',
-                chat_id=update.effective_chat.id,
+            latency = time.perf_counter() - start
+            stats.inc('das_commands_total', command=func.__name__, outcome='error')
+            stats.observe('das_command_seconds', latency, command=func.__name__)
+
+            # the traceback is formatted by the log writer, not on the handler thread
+            system_log.error(f'callback failed: {error!r}', exc_info=error, extra=dict(record, latency=latency))
+
+            outbox.send_message(
+                context.bot, update.effective_chat.id,
+                'Ein interner Fehler ist aufgetreten, ich kann die Nachricht nicht verarbeiten! O.o',
                 parse_mode=telegram.ParseMode.MARKDOWN
             )
 
-            raise error
+            return
+
+        latency = time.perf_counter() - start
+        stats.inc('das_commands_total', command=func.__name__, outcome='ok')
+        stats.observe('das_command_seconds', latency, command=func.__name__)
+
+        system_msg.info(f'callback: {record["chat"]} ({record["user"]}) --> {record["command"]}',
+                        extra=dict(record, latency=latency))
 
     return wrapper
 
 
 @callback
-def cmd_start(update, context, *args, **kwargs):
+async def cmd_start(update, context, *args, **kwargs):
     return 'Hallo, ich bin `das System`.\n\n' \
            'Mit `\\help` bekommst du eine Übersicht der Befehle und deines aktuellen Zustands.'
 
 
 @callback
-def cmd_help(update, context, state):
-    return TEMPLATE_HELP.format(
-        active=state.active,
-        active_help=Challenge.load(state).help if state.active else '',
-        challenges=tabulate(
-            [(c.name, c.unlocked, c.solved) for c in Challenge.list(state)],
-            ['challenge', 'unlocked', 'solved'],
-            tablefmt='fancy_grid')
-    )
+async def cmd_help(update, context, state):
+    # the help only depends on the progress, most users share one of a few variants
+    key = ChallengeMeta.version, Challenge.progress(state), state.active
+    msg = help_cache.get(key)
+
+    if msg is None:
+        msg = TEMPLATE_HELP.format(
+            active=state.active,
+            active_help=Challenge.load(state).help if state.active else '',
+            challenges=tabulate(
+                [(c.name, c.unlocked, c.solved) for c in Challenge.list(state)],
+                ['challenge', 'unlocked', 'solved'],
+                tablefmt='fancy_grid')
+        )
+        help_cache.put(key, msg)
+
+    return msg
 
 
 @callback
-def cmd_challenge(update, context, state, *args, **kwargs):
+async def cmd_challenge(update, context, state, *args, **kwargs):
     if state.active is not None:
         return f'*Es ist bereits Challenge "{state.active}" aktiv*\n\n' \
                f'{Challenge.registry[state.active].help}'
@@ -168,9 +210,9 @@ def cmd_challenge(update, context, state, *args, **kwargs):
         challenge = random.choice(list(candidates.values()))
         state.active = challenge.name
 
-        context.bot.send_message(
-            text=f'Challenge `{challenge.name}` wurde aktiviert',
-            chat_id=update.effective_chat.id,
+        outbox.send_message(
+            context.bot, update.effective_chat.id,
+            f'Challenge `{challenge.name}` wurde aktiviert',
             parse_mode=telegram.ParseMode.MARKDOWN
         )
 
@@ -180,7 +222,7 @@ def cmd_challenge(update, context, state, *args, **kwargs):
 
 
 @callback
-def cmd_giveup(update, context, state):
+async def cmd_giveup(update, context, state):
     if not state.active:
         return 'Du machst doch gerade gar keine Challenge🦦 '
 
@@ -189,37 +231,117 @@ def cmd_giveup(update, context, state):
     return 'schade Schokolade :/'
 
 
+async def judge(update, context, challenge):
+    code = await extract_source(update)
+    verdict = verdicts.get(challenge.name, code)
+
+    if verdict is None:
+        await challenge.submit(update, context, code)
+
+        if not challenge.transient:
+            verdicts.put(challenge.name, code, challenge.verdict, challenge.deterministic)
+    else:
+        await challenge.restore(update, context, verdict)
+
+
+@submissions.admit
 @callback
-def cmd_submit(update, context, state):
+async def cmd_submit(update, context, state):
     if not state.active:
         return 'Cool cool, aber was soll ich damit anfangen?'
 
     challenge = Challenge.load(state)
-    with timeout(60):
-        challenge.submit(update, context)
+
+    # downloading the source, waiting for the turn of the user and the execution are limited
+    # each, a submission waiting too long is answered as busy
+    try:
+        # a newer submission arrived while this one was waiting for the lock of the user
+        submissions.check(update)
+
+        await judge(update, context, challenge)
+
+    except SubmissionError as error:
+        return str(error)
 
     if challenge.solved:
         state.active = None
         state.solved.append(challenge.name)
         return f'Cool! Du hast die Challenge `{challenge.name}` gelöst!'
 
+    if challenge.results:
+        passed = sum(r['passed'] for r in challenge.results)
+        return f'Die Lösung war leider nicht korrekt :/\n\n{passed} von {len(challenge.results)} Tests bestanden'
+
     return 'Die Lösung war leider nicht korrekt :/'
 
 
 @callback
-def cmd_reset(update, context, state):
+async def cmd_reset(update, context, state):
     state.clear()
     state.update(initial_state())
     return 'Dein Zustand wurde gelöscht!'
 
 
-def cmd_echo(update, context):
-    context.bot.send_message(text=' '.join(context.args), chat_id=update.effective_chat.id)
+def is_admin(update):
+    return update.effective_user.name in _CONTEXT.config.telegram.get('admins', [])
+
+
+@callback
+async def cmd_stats(update, context, state):
+    if not is_admin(update):
+        return 'Das darfst du nicht.'
+
+    _, histograms, gauges = stats.collect()
+
+    def _row(title, h):
+        return title, h.count, f'{h.sum / h.count * 1000:.0f}', f'{h.quantile(.95) * 1000:.0f}'
+
+    # command latencies first, followed by the components they are made of
+    rows = sorted(
+        (name != 'das_command_seconds', _row(' '.join([name[4:-8], *(v for _, v in labels)]), h))
+        for (name, labels), h in histograms.items()
+    )
+    latencies = tabulate([row for _, row in rows], ['', 'n', 'avg ms', 'p95 ms'])
+
+    values = {(name, labels): value for (name, labels), (value, _) in gauges.items()}
+
+    def _rate(cache):
+        hits = values.get(('das_cache_hits_total', (('cache', cache),)), 0)
+        misses = values.get(('das_cache_misses_total', (('cache', cache),)), 0)
+        return f'{hits / (hits + misses):.0%}' if hits + misses else '-'
+
+    return f'*Statistik*\n```\n{latencies}\n```\n' \
+           f'Warteschlange Einsendungen: {values.get(("das_submissions_pending", ()), 0)}, ' \
+           f'Ausführung: {values.get(("das_executor_queue_depth", ()), 0)}, ' \
+           f'TTS: {values.get(("das_tts_queue_depth", ()), 0)}, ' \
+           f'Versand: {values.get(("das_outbox_queue_depth", ()), 0)}\n' \
+           f'Trefferquote Urteile: {_rate("verdict")}, Hilfe: {_rate("help")}, Zustände: {_rate("state")}'
 
 
-def cmd_tts_echo(update, context):
-    with tts(' '.join(context.args)) as f:
-        context.bot.send_voice(chat_id=update.effective_chat.id, voice=f)
+@callback
+async def cmd_profile(update, context, state):
+    if not is_admin(update):
+        return 'Das darfst du nicht.'
+
+    if context.args:
+        try:
+            rate = 0. if context.args[0] == 'off' else float(context.args[0])
+
+        except ValueError:
+            return 'Benutzung: `\\profile [anteil|off]`'
+
+        profiler.configure(rate=min(max(rate, 0.), 1.))
+        system_log.info(f'profiling rate set to {profiler.rate} by {update.effective_user.name}')
+
+    return f'Profiling: {profiler.rate:.0%} der Aufrufe, Ergebnisse in `{profiler.path}`'
+
+
+async def cmd_echo(update, context):
+    outbox.send_message(context.bot, update.effective_chat.id, ' '.join(context.args))
+
+
+async def cmd_tts_echo(update, context):
+    media.speak(context.bot, update.effective_chat.id, ' '.join(context.args))
 
 
 def echo(update, context):
@@ -227,59 +349,236 @@ def echo(update, context):
 
 
 def voice(update, context):
-    msg = 'Joooo! Ich kann zwar reden, aber glaub bloß nicht, dass ich dir zuhöre.'
-    with tts(msg) as buffer:
-        context.bot.send_voice(chat_id=update.effective_chat.id, voice=buffer)
+    media.speak(context.bot, update.effective_chat.id, VOICE_REPLY)
+
+
+def load_config():
+    path = os.path.expanduser(os.environ.get('CONFIG_PATH', '~/.das_system'))
+
+    os.makedirs(path, exist_ok=True)
+
+    with open(os.path.join(path, 'config.json'), mode='rt') as f:
+        return path, NameSpaceDict(json.load(f))
+
+
+def receive(updater, settings, backlog=None):
+    """Starts receiving updates by polling or, given the `settings` of a webhook, by a webhook
+    server, which is returned. `backlog` is passed to :class:`WebhookServer`."""
+    if settings is None:
+        updater.start_polling(clean=True)
+        return None
+
+    webhook = WebhookServer(
+        updater.bot, updater.update_queue,
+        settings.get('listen', '127.0.0.1'), settings.get('port', 8443), settings.get('path', '/'),
+        settings.get('secret'), settings.get('max_pending', 1000), backlog,
+    ).start()
+
+    threading.Thread(target=updater.dispatcher.start, name='dispatcher', daemon=True).start()
+
+    # without an url the webhook has to be registered elsewhere, e.g. behind a proxy
+    if settings.get('url'):
+        updater.bot.set_webhook(settings.url, drop_pending_updates=True, secret_token=settings.get('secret'))
+
+    system_log.debug(f'listening for webhook updates on port {webhook.server_address[1]}')
+    return webhook
+
+
+def socket_path(path, config):
+    return os.path.join(path, config.get('sharding', {}).get('socket', 'ingress.sock'))
 
 
 class BotContext(SingletonContextABC):
     def __on_open__(self):
+        global _CONTEXT
         system_log.debug('open crawler context')
 
-        self.path = os.path.expanduser(os.environ.get('CONFIG_PATH', '~/.das_system'))
+        self.path, self.config = load_config()
+
+        logs.sample(self.config.get('logging', {}).get('sample', 1.))
 
-        os.makedirs(self.path, exist_ok=True)
+        settings = self.config.get('profiling', {})
+        profiler.configure(os.path.join(self.path, 'profiles'), settings.get('top'), settings.get('rate'))
 
-        with open(os.path.join(self.path, 'config.json'), mode='rt') as f:
-            self.config = NameSpaceDict(json.load(f))
+        settings = self.config.get('state', {})
+        store = BACKENDS[settings.get('backend', 'sqlite')](self.path)
 
-        with open(os.path.join(self.path, 'state.json'), mode='rt') as f:
-            self.state = NameSpaceDict(json.load(f))
+        if isinstance(store, SQLiteStore):
+            migrated = store.migrate(self.path)
+            if migrated:
+                system_log.info(f'migrated {migrated} users from json state to sqlite')
 
-        system_log.debug(f'loaded config and state from: {self.path}')
+        # handlers are coroutines, the locks must not block the event loop
+        self.states = UserStates(store, settings.get('cache_size', 1024), factory=initial_state,
+                                 locks=KeyedLock(factory=asyncio.Lock))
+        self.chats = set(self.config.telegram.chats)
+        self.dirty = NameSpaceDict(config=False)
+        self.lock = threading.Lock()
 
-        self.telegram = Updater(token=self.config.telegram.token, use_context=True)
-        self.telegram.dispatcher.add_handler(CommandHandler('start', cmd_start))
-        self.telegram.dispatcher.add_handler(CommandHandler('help', cmd_help))
-        self.telegram.dispatcher.add_handler(CommandHandler('challenge', cmd_challenge))
-        self.telegram.dispatcher.add_handler(CommandHandler('giveup', cmd_giveup))
-        self.telegram.dispatcher.add_handler(CommandHandler('reset', cmd_reset))
-        self.telegram.dispatcher.add_handler(CommandHandler('echo', cmd_echo))
-        self.telegram.dispatcher.add_handler(CommandHandler('ttsecho', cmd_tts_echo))
-        self.telegram.dispatcher.add_handler(MessageHandler(Filters.all, cmd_submit))
-        self.telegram.start_polling(clean=True)
+        system_log.debug(f'loaded config and opened state store at: {self.path}')
 
-        system_log.debug(f'launched telegram updater')
+        # handlers must not enter the context. closing it while one of them waits would be
+        # skipped, and a handler starting meanwhile would block the event loop. the handlers are
+        # drained before the context is gone
+        _CONTEXT = self
+
+        # fork the workers before the updater starts its threads
+        settings = self.config.get('executor', {})
+        pool = executor.start(
+            settings.get('workers'), settings.get('max_jobs', 100),
+            max_output=settings.get('max_output', MAX_OUTPUT),
+            cpu_limit=settings.get('cpu_limit', 10),
+            memory_limit=settings.get('memory_limit', 256 * 1024 ** 2),
+        )
+
+        system_log.debug(f'started executor with {pool.size} workers')
+
+        # the scheduler decides which submission runs next, the workers never have to queue. by
+        # default, no more submissions wait than the workers may clear within `max_wait`
+        max_wait = settings.get('max_wait', 60)
+        submissions.configure(pool.size, settings.get('max_pending', pool.size * max_wait // EXECUTION_TIMEOUT),
+                              max_wait)
+
+        settings = self.config.get('tts', {})
+        tts_cache.configure(os.path.join(self.path, 'tts'), settings.get('max_bytes'))
+        tts_renderer.configure(settings.get('workers'), settings.get('queue_size'))
+
+        for msg in [VOICE_REPLY, *Challenge.voices()]:
+            try:
+                tts_cache.render(msg)
+
+            except (OSError, subprocess.CalledProcessError) as error:
+                system_log.warning(f'could not render "{msg}" ahead of time: {error}')
+
+        system_log.debug(f'rendered fixed voice messages into: {tts_cache.path}')
+
+        media.registry.load(self.path)
+
+        settings = self.config.get('documents', {})
+        media.documents.configure(settings.get('max_bytes'), settings.get('cache_size'))
+
+        settings = self.config.get('outbox', {})
+        outbox.configure(settings.get('rate'), settings.get('chat_rate'), settings.get('burst'),
+                         settings.get('window'), settings.get('workers'))
+
+        stats.gauge('das_executor_queue_depth', executor.queue_depth)
+        stats.gauge('das_submissions_pending', submissions.depth)
+        stats.gauge('das_tts_queue_depth', tts_renderer.depth)
+        stats.gauge('das_outbox_queue_depth', outbox.depth)
+
+        caches = ('verdict', verdicts.cache), ('help', help_cache), ('state', self.states.cache), \
+                 ('document', media.documents.cache)
+
+        for name, cache in caches:
+            stats.gauge('das_cache_hits_total', lambda c=cache: c.hits, kind='counter', cache=name)
+            stats.gauge('das_cache_misses_total', lambda c=cache: c.misses, kind='counter', cache=name)
+            stats.gauge('das_cache_size', cache.__len__, cache=name)
+
+        # `base_url` points the bot to another bot api server, e.g. the one of `benchmark.py load`
+        self.telegram = Updater(token=self.config.telegram.token, base_url=self.config.telegram.get('base_url'),
+                                base_file_url=self.config.telegram.get('base_file_url'), workers=0,
+                                use_context=True)
+
+        # the dispatcher of `telegram.ext` only feeds the event loop running the handlers
+        settings = self.config.get('dispatch', {})
+        self.dispatcher = AsyncDispatcher(self.telegram.dispatcher, settings.get('workers', 8),
+                                          settings.get('max_tasks', 1000)).start()
+        self.dispatcher.add_handler(CommandHandler('start', cmd_start))
+        self.dispatcher.add_handler(CommandHandler('help', cmd_help))
+        self.dispatcher.add_handler(CommandHandler('challenge', cmd_challenge))
+        self.dispatcher.add_handler(CommandHandler('giveup', cmd_giveup))
+        self.dispatcher.add_handler(CommandHandler('reset', cmd_reset))
+        self.dispatcher.add_handler(CommandHandler('stats', cmd_stats))
+        self.dispatcher.add_handler(CommandHandler('profile', cmd_profile))
+        self.dispatcher.add_handler(CommandHandler('echo', cmd_echo))
+        self.dispatcher.add_handler(CommandHandler('ttsecho', cmd_tts_echo))
+        self.dispatcher.add_handler(MessageHandler(Filters.all, cmd_submit))
+
+        stats.gauge('das_dispatch_tasks', self.dispatcher.depth)
+
+        if SHARD is None:
+            self.shard = None
+            # updates being handled count as pending, the dispatcher hands them over right away
+            self.webhook = receive(self.telegram, self.config.telegram.get('webhook'),
+                                   lambda: self.telegram.update_queue.qsize() + self.dispatcher.depth())
+            system_log.debug(f'launched telegram updater')
+
+        else:
+            # the ingress routes the updates of our users here, they skip `telegram.ext`
+            self.webhook = None
+            self.shard = ShardClient(socket_path(self.path, self.config), SHARD, self.telegram.bot,
+                                     self.dispatcher.put, self.release).start()
+            system_log.debug(f'connecting to the ingress as {SHARD}')
 
     def __on_close__(self):
-        self.persist()
+        global _CONTEXT
+        # the users are handed over while everything still works
+        if self.shard is not None:
+            self.shard.leave()
+            self.shard.stop()
+            system_log.debug(f'left the ingress')
+
+        if self.webhook is not None:
+            self.webhook.stop()
 
         self.telegram.stop()
         system_log.debug(f'stopped telegram updater')
 
+        # let the handlers still running finish
+        self.dispatcher.stop()
+        system_log.debug(f'stopped dispatcher')
+
+        outbox.close()
+        system_log.debug(f'sent outgoing messages')
+
+        executor.shutdown()
+        system_log.debug(f'stopped executor')
+
+        self.persist()
+        self.states.close()
+
+        _CONTEXT = None
+
         del self.path
         del self.config
-        del self.state
+        del self.states
+        del self.chats
+        del self.dirty
+        del self.lock
         del self.telegram
+        del self.dispatcher
+        del self.webhook
+        del self.shard
 
         system_log.debug('close bot context')
 
+    def release(self, members):
+        # handlers of updates routed here before must not race the new owners of their users
+        self.dispatcher.drain()
+        self.states.release(lambda user: owner(user, members) != SHARD)
+
+        system_log.info(f'released users, workers: {members}')
+
     def persist(self):
-        with open(os.path.join(self.path, 'config.json'), mode='wt') as f:
-            json.dump(self.config, f, indent=4)
+        with stats.timer('das_persist_seconds'):
+            self._persist()
+
+    def _persist(self):
+        # an idle tick must not touch the disk at all
+        with self.lock:
+            config = None
 
-        with open(os.path.join(self.path, 'state.json'), mode='wt') as f:
-            json.dump(self.state, f, indent=4)
+            # the chats of a sharded deployment are recorded by the ingress
+            if self.dirty.config and SHARD is None:
+                self.dirty.config = False
+                self.config.telegram.chats = sorted(self.chats)
+                config = copy.deepcopy(self.config)
+
+        if config is not None:
+            atomic_dump(config, os.path.join(self.path, 'config.json'), indent=4)
+
+        self.states.flush()
+        media.registry.persist()
 
 
 def signal_handler(sig, frame):
@@ -290,10 +589,107 @@ def signal_handler(sig, frame):
 signal.signal(signal.SIGINT, signal_handler)
 
 
+def ingress(path, config):
+    """
+    Receives the updates and routes them by user to the workers, `sharding.workers` of them are
+    started and restarted by this process. More workers may join by starting the bot with the
+    environment variable `SHARD` set to a name of their own.
+    """
+    # the journal is held in memory, every worker would overwrite the users of the others
+    if config.get('state', {}).get('backend', 'sqlite') != 'sqlite':
+        raise ValueError('sharding requires the sqlite state backend')
+
+    settings = config.sharding
+    router = Ingress(socket_path(path, config), settings.get('timeout', 60)).start()
+
+    chats, lock = set(config.telegram.chats), threading.Lock()
+
+    def _route(update, context):
+        # like the workers, only chats of allowed users are recorded
+        user = update.effective_user
+        if update.effective_chat is not None and user is not None \
+                and user.name in config.telegram.allowed_users:
+            with lock:
+                chats.add(update.effective_chat.id)
+
+        router.route(update)
+
+    updater = Updater(token=config.telegram.token, base_url=config.telegram.get('base_url'),
+                        base_file_url=config.telegram.get('base_file_url'), workers=0, use_context=True)
+    updater.dispatcher.add_handler(TypeHandler(telegram.Update, _route))
+
+    stats.gauge('das_ingress_workers', router.size)
+    stats.gauge('das_ingress_held', router.depth)
+
+    def _spawn(name):
+        return subprocess.Popen([sys.executable, os.path.abspath(__file__)],
+                                env={**os.environ, 'CONFIG_PATH': path, 'SHARD': name})
+
+    workers = {f'worker-{i}': _spawn(f'worker-{i}') for i in range(settings.get('workers', 2))}
+    webhook = receive(updater, config.telegram.get('webhook'))
+
+    interval = config.get('metrics', {}).get('interval', 15)
+    written, known = time.monotonic(), len(chats)
+
+    try:
+        while True:
+            for name, process in workers.items():
+                if process.poll() is not None:
+                    system_log.warning(f'{name} exited with {process.returncode}, restarting it')
+                    workers[name] = _spawn(name)
+
+            with lock:
+                if len(chats) != known:
+                    known, config.telegram.chats = len(chats), sorted(chats)
+                    atomic_dump(config, os.path.join(path, 'config.json'), indent=4)
+
+            if time.monotonic() - written >= interval:
+                written = time.monotonic()
+                stats.write(os.path.join(path, 'metrics.prom'))
+
+            time.sleep(1)
+
+    finally:
+        if webhook is not None:
+            webhook.stop()
+
+        updater.stop()
+
+        # the workers hand their users over to each other while leaving
+        for process in workers.values():
+            process.send_signal(signal.SIGINT)
+
+        for process in workers.values():
+            try:
+                process.wait(settings.get('timeout', 60))
+
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+        if router.depth():
+            system_log.warning(f'dropped {router.depth()} updates no worker received')
+
+        router.stop()
+
+
 def main():
+    path, config = load_config()
+
+    # with sharding, this process only routes the updates to the processes doing the work
+    if 'sharding' in config and SHARD is None:
+        return ingress(path, config)
+
     with BotContext() as ctx:
+        interval = ctx.config.get('metrics', {}).get('interval', 15)
+        written = time.monotonic()
+
         while True:
             ctx.persist()
+
+            if time.monotonic() - written >= interval:
+                written = time.monotonic()
+                stats.write(os.path.join(ctx.path, 'metrics.prom' if SHARD is None else f'metrics-{SHARD}.prom'))
+
             time.sleep(1)
 
 
@@ -0,0 +1,446 @@
+#!/usr/bin/env python3
+# Standard library modules.
+import os
+import re
+import sys
+import json
+import time
+import queue
+import random
+import signal
+import socket
+import argparse
+import tempfile
+import textwrap
+import threading
+import subprocess
+from contextlib import contextmanager
+from collections import defaultdict
+
+# Third party modules.
+
+# Local modules
+from util import timeout
+from fakegram import FakeTelegram
+from persistence import SQLiteStore, UserStates
+
+# Globals and constants variables.
+TIGHT_LOOP = """
+x = 0
+for i in range({n}):
+    x += i % 7
+"""
+
+# the challenges in the order a user unlocks them, `OutsideTheBox` can't be started yet
+CHAIN = ('HelloWorld', 'LongestString', 'FizzBuzz', 'Palindrome', 'CaesarI', 'CaesarII', 'Classes')
+
+BAD_SUBMISSIONS = dict(
+    wrong="print('hello')\nraise ValueError('wrong answer')",
+    slow='import time\ntime.sleep({slow})',
+    loop='while True:\n    pass',
+)
+
+
+@contextmanager
+def settrace_timeout(timeout_):
+    # the line tracing implementation `util.timeout` used before, kept as baseline
+    start = time.time()
+
+    def _globaltrace(frame, event, arg):
+        return _localtrace if event == 'call' else None
+
+    def _localtrace(frame, event, arg):
+        if time.time() - start >= timeout_ and event == 'line':
+            raise TimeoutError(f'code execution took longer than {timeout_:.3f}s to terminate')
+
+    sys.settrace(_globaltrace)
+
+    try:
+        yield start
+
+    finally:
+        sys.settrace(None)
+
+
+def _best_of(repeat, func):
+    timings = []
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+
+    return min(timings)
+
+
+def bench_timeout(args):
+    # wrap the loop in a function, the trace is only installed for frames called afterwards
+    body = textwrap.indent(TIGHT_LOOP.format(n=args.n), '    ')
+    code = compile(f'def main():\n{body}\nmain()', '<benchmark>', 'exec')
+
+    def run(guard):
+        def _run():
+            with guard(60):
+                exec(code, {})
+
+        return _best_of(args.repeat, _run)
+
+    @contextmanager
+    def unguarded(_):
+        yield
+
+    baseline = run(unguarded)
+    results = [('none', baseline), ('settrace', run(settrace_timeout)), ('watchdog', run(timeout))]
+
+    print(f'tight loop with {args.n} iterations, best of {args.repeat}')
+    for name, seconds in results:
+        print(f'  {name:<10} {seconds:8.4f}s  {seconds / baseline:6.2f}x')
+
+
+def bench_stress(args):
+    # every simulated user appends its update numbers, a lost update shows up as a gap
+    def run(threads):
+        with tempfile.TemporaryDirectory() as path:
+            states = UserStates(SQLiteStore(path), maxsize=args.cache_size, factory=lambda: dict(seen=[]))
+            done = threading.Event()
+
+            def _user(users):
+                for i in range(args.updates):
+                    for user in users:
+                        with states.locks[user]:
+                            state = states.get(user)
+                            state.seen.append(i)
+                            states.mark_dirty(user, state)
+
+            def _flusher():
+                while not done.wait(.01):
+                    states.flush()
+
+            # several users per thread, so records get evicted while others are in use
+            workers = [threading.Thread(target=_user, args=([f'user-{t}-{u}' for u in range(args.users)],))
+                       for t in range(threads)]
+            flusher = threading.Thread(target=_flusher)
+
+            start = time.perf_counter()
+            flusher.start()
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            seconds = time.perf_counter() - start
+
+            done.set()
+            flusher.join()
+            states.close()
+
+            store = SQLiteStore(path)
+            expected = list(range(args.updates))
+            lost = sum(
+                (store.load(f'user-{t}-{u}') or dict(seen=[]))['seen'] != expected
+                for t in range(threads) for u in range(args.users)
+            )
+            store.close()
+
+        return threads * args.users * args.updates / seconds, lost
+
+    print(f'{args.users} users per thread, {args.updates} updates each, cache size {args.cache_size}')
+    for threads in args.threads:
+        rate, lost = run(threads)
+        print(f'  {threads:>3} threads  {rate:10.0f} updates/s  {lost} users with lost updates')
+
+
+def reference_answers():
+    """The correct submission of each challenge in `CHAIN`, taken from `solutions.py`."""
+    import inspect
+    import challenge
+
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'solutions.py'), encoding='utf-8') as f:
+        parts = re.split(r'^#+ (\w+)\n', f.read(), flags=re.M)
+
+    preamble, sections = parts[0], dict(zip(parts[1::2], parts[2::2]))
+    answers = {name: sections[name].strip() for name in CHAIN}
+
+    # CaesarI expects the decrypted sentence, CaesarII the source of `OutsideTheBox`
+    namespace = {}
+    exec(preamble + sections['CaesarI'], namespace)
+    key, cipher = re.search(r'\*(\d+)\*.*\*"(.+)"\*', challenge.CaesarI.prompt(), flags=re.S).groups()
+    answers['CaesarI'] = namespace['caesar'](cipher, -int(key))
+    answers['CaesarII'] = inspect.getsource(challenge.OutsideTheBox)
+
+    return answers
+
+
+def load_script(username, answers, rng, args):
+    steps = [('start', '/start'), ('help', '/help')]
+
+    for name in CHAIN:
+        steps.append(('challenge', f'/challenge {name}'))
+
+        for kind in BAD_SUBMISSIONS:
+            if rng.random() < getattr(args, kind):
+                steps.append((kind, BAD_SUBMISSIONS[kind].format(slow=args.slow_seconds)))
+
+        # quick edits, all but the first and the last one are superseded
+        if args.burst and rng.random() < args.burst:
+            steps.append(('burst', [f'{BAD_SUBMISSIONS["slow"].format(slow=args.slow_seconds)}\n# {i}'
+                                    for i in range(args.burst_size)]))
+
+        # users don't share code, so verdicts aren't served from the cache
+        answer = answers[name] if name == 'CaesarI' else f'{answers[name]}\n# {username}'
+        kind = 'document' if name != 'CaesarI' and args.documents and rng.random() < args.documents else 'correct'
+        steps += [(kind, answer), ('help', '/help')]
+
+    return steps
+
+
+def _rss(pid):
+    try:
+        with open(f'/proc/{pid}/status', encoding='utf-8') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+
+    except FileNotFoundError:
+        pass
+
+    return 0
+
+
+def _children(pid):
+    children = []
+
+    for entry in filter(str.isdigit, os.listdir('/proc')):
+        try:
+            with open(f'/proc/{entry}/stat', encoding='utf-8') as f:
+                # the parent pid follows the state, behind the parenthesized command name
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+
+        except (OSError, IndexError, ValueError):
+            continue
+
+        if ppid == pid:
+            children.append(int(entry))
+
+    return children
+
+
+def _descendants(pid):
+    children = _children(pid)
+    return children + [d for child in children for d in _descendants(child)]
+
+
+def _percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def bench_load(args):
+    if args.replay:
+        with open(args.replay, encoding='utf-8') as f:
+            scripts = {}
+            for line in f:
+                entry = json.loads(line)
+                scripts.setdefault(entry['user'], []).append((entry['kind'], entry['text']))
+    else:
+        answers, rng = reference_answers(), random.Random(args.seed)
+        scripts = {f'load_user_{i}': load_script(f'load_user_{i}', answers, rng, args) for i in range(args.users)}
+
+    if args.record:
+        with open(args.record, mode='wt', encoding='utf-8') as f:
+            for user, steps in scripts.items():
+                f.writelines(json.dumps(dict(user=user, kind=kind, text=text)) + '\n' for kind, text in steps)
+
+    server = FakeTelegram().start()
+    results, memory = [], []
+
+    def _user(chat_id, username, steps):
+        replies = server.replies[chat_id]
+
+        for kind, text in steps:
+            # late replies of the previous step, e.g. voice messages
+            while not replies.empty():
+                replies.get_nowait()
+
+            if kind == 'document':
+                sent = server.send_document(chat_id, username, text.encode('utf-8'))
+            elif kind == 'burst':
+                sent = min(server.send(chat_id, username, t) for t in text)
+            else:
+                sent = server.send(chat_id, username, text)
+
+            try:
+                last, _ = replies.get(timeout=args.reply_timeout)
+
+            except queue.Empty:
+                results.append((kind, None))
+                continue
+
+            # a command is answered once the bot stays silent for a moment
+            while True:
+                try:
+                    last, _ = replies.get(timeout=args.quiet)
+
+                except queue.Empty:
+                    break
+
+            results.append((kind, last - sent))
+
+    with tempfile.TemporaryDirectory() as path:
+        config = dict(
+            telegram=dict(token='123456:load', base_url=server.url, base_file_url=server.file_url, chats=[],
+                          admins=[], allowed_users=[f'@{user}' for user in scripts]),
+            executor=dict(workers=args.workers),
+            metrics=dict(interval=1),
+            outbox=dict(chat_rate=args.chat_rate),
+        )
+
+        if args.shards:
+            config['sharding'] = dict(workers=args.shards)
+
+        if args.webhook:
+            with socket.socket() as sock:
+                sock.bind(('127.0.0.1', 0))
+                port = sock.getsockname()[1]
+
+            config['telegram']['webhook'] = dict(port=port, path='/telegram', secret='load',
+                                                 url=f'http://127.0.0.1:{port}/telegram')
+
+        with open(os.path.join(path, 'config.json'), mode='wt', encoding='utf-8') as f:
+            json.dump(config, f)
+
+        with open(os.path.join(path, 'bot.out'), mode='wb') as out:
+            bot = subprocess.Popen(
+                [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), '__main__.py')],
+                env={**os.environ, 'CONFIG_PATH': path}, stdout=out, stderr=subprocess.STDOUT
+            )
+
+        if not server.ready.wait(60):
+            bot.kill()
+            with open(os.path.join(path, 'bot.out'), encoding='utf-8', errors='replace') as f:
+                sys.exit(f'the bot did not connect:\n{f.read()}')
+
+        users = [threading.Thread(target=_user, args=(chat_id, user, steps), daemon=True)
+                 for chat_id, (user, steps) in enumerate(scripts.items(), 1)]
+
+        start = time.perf_counter()
+        for user in users:
+            user.start()
+
+        restarted = start
+
+        while any(user.is_alive() for user in users):
+            children = _descendants(bot.pid)
+            memory.append((time.perf_counter() - start, _rss(bot.pid), sum(map(_rss, children)), len(children)))
+
+            # a worker leaves gracefully, the ingress starts it again and it joins once more
+            if args.shards and args.restart_worker and time.perf_counter() - restarted >= args.restart_worker:
+                restarted = time.perf_counter()
+                shards = _children(bot.pid)
+
+                if shards:
+                    os.kill(random.choice(shards), signal.SIGINT)
+
+            time.sleep(args.interval)
+
+        duration = time.perf_counter() - start
+
+        bot.send_signal(signal.SIGINT)
+        try:
+            bot.wait(60)
+
+        except subprocess.TimeoutExpired:
+            bot.kill()
+
+        server.stop()
+
+        # every worker of a sharded bot writes its own file
+        metrics = ''
+        for name in sorted(os.listdir(path)):
+            if name.startswith('metrics') and name.endswith('.prom'):
+                with open(os.path.join(path, name), encoding='utf-8') as f:
+                    metrics += f.read()
+
+    print(f'{len(scripts)} users, {len(results)} messages in {duration:.1f}s ({len(results) / duration:.1f} messages/s)')
+
+    print(f'\nlatency (ms){"n":>10}{"lost":>6}{"p50":>8}{"p95":>8}{"p99":>8}')
+    for kind in ['start', 'help', 'challenge', 'correct', 'document', *BAD_SUBMISSIONS, 'burst', 'all']:
+        values = [t for k, t in results if kind in (k, 'all')]
+        answered = [t * 1000 for t in values if t is not None]
+
+        if answered:
+            print(f'  {kind:<10}{len(values):>10}{len(values) - len(answered):>6}' +
+                  ''.join(f'{_percentile(answered, q):8.0f}' for q in (.5, .95, .99)))
+
+    if server.files:
+        print(f'\n{len(server.files)} documents, downloaded {server.downloads} times')
+
+    print(f'\nmemory (MiB){"bot":>10}{"workers":>10}')
+    for t, bot_rss, workers_rss, workers in memory[::max(1, len(memory) // 20)]:
+        print(f'  {t:8.1f}s{bot_rss / 1024 ** 2:10.1f}{workers_rss / 1024 ** 2:10.1f}  ({workers} workers)')
+
+    # what the bot measured itself, e.g. sandbox, persist and help timings
+    print(f'\nbot timings (ms){"n":>30}{"avg":>8}')
+    timings = defaultdict(float)
+    for name, kind, labels, value in re.findall(r'^(das_\w+_seconds)_(sum|count)(\{.*?\})? (\S+)$', metrics, flags=re.M):
+        timings[name, labels, kind] += float(value)
+
+    for (name, labels, kind), count in sorted(timings.items()):
+        if kind == 'count' and count:
+            title = f'{name[4:-8]} {labels}'.strip()
+            print(f'  {title:<40}{count:>6.0f}{timings[name, labels, "sum"] / count * 1000:8.1f}')
+
+    counters = defaultdict(float)
+    for name, labels, value in re.findall(r'^das_(submissions|outbox_messages|documents|ingress_updates)_total(\{.*?\}) (\S+)$',
+                                          metrics, flags=re.M):
+        counters[f'{name} {labels}'] += float(value)
+
+    if counters:
+        print(f'\nbot counters{"n":>34}')
+        for title, value in sorted(counters.items()):
+            print(f'  {title:<40}{value:>6.0f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='das system benchmarks')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    parser_timeout = commands.add_parser('timeout', help='overhead of execution timeouts')
+    parser_timeout.add_argument('-n', type=int, default=1_000_000)
+    parser_timeout.add_argument('--repeat', type=int, default=5)
+    parser_timeout.set_defaults(func=bench_timeout)
+
+    parser_stress = commands.add_parser('stress', help='parallel users updating their state')
+    parser_stress.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser_stress.add_argument('--users', type=int, default=16)
+    parser_stress.add_argument('--updates', type=int, default=200)
+    parser_stress.add_argument('--cache-size', type=int, default=32)
+    parser_stress.set_defaults(func=bench_stress)
+
+    parser_load = commands.add_parser('load', help='simulated users against a fake telegram backend')
+    parser_load.add_argument('--users', type=int, default=20)
+    parser_load.add_argument('--workers', type=int, default=None)
+    parser_load.add_argument('--wrong', type=float, default=.3, help='chance of a wrong submission')
+    parser_load.add_argument('--slow', type=float, default=.1, help='chance of a slow submission')
+    parser_load.add_argument('--slow-seconds', type=float, default=1.)
+    parser_load.add_argument('--loop', type=float, default=.02, help='chance of an endless loop')
+    parser_load.add_argument('--burst', type=float, default=.1, help='chance of quickly edited submissions')
+    parser_load.add_argument('--burst-size', type=int, default=3)
+    parser_load.add_argument('--documents', type=float, default=.2, help='chance of a correct answer sent as file')
+    parser_load.add_argument('--seed', type=int, default=0)
+    parser_load.add_argument('--quiet', type=float, default=.25, help='silence that ends a reply')
+    parser_load.add_argument('--reply-timeout', type=float, default=60.)
+    parser_load.add_argument('--interval', type=float, default=1., help='memory sampling interval')
+    parser_load.add_argument('--record', help='store the generated conversations as json lines')
+    parser_load.add_argument('--replay', help='replay recorded conversations')
+    parser_load.add_argument('--webhook', action='store_true', help='post updates to a webhook instead of polling')
+    parser_load.add_argument('--shards', type=int, default=0, help='worker processes of a sharded bot')
+    parser_load.add_argument('--restart-worker', type=float, default=0, help='seconds between worker restarts')
+    parser_load.add_argument('--chat-rate', type=float, default=None, help='messages per second the bot sends per chat')
+    parser_load.set_defaults(func=bench_load)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
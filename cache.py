@@ -0,0 +1,122 @@
+# Standard library modules.
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+# Third party modules.
+
+# Local modules
+
+# Globals and constants variables.
+_MISSING = object()
+
+
+class LRUCache:
+    """
+    Thread safe mapping holding at most `maxsize` items. When full, the least recently used
+    item is dropped and handed to `on_evict(key, value)`. Items stored with a `ttl` (seconds)
+    vanish once it elapsed.
+    """
+
+    def __init__(self, maxsize=128, on_evict=None):
+        self.maxsize = maxsize
+        self.on_evict = on_evict
+        self.hits = 0
+        self.misses = 0
+
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+
+    def _lookup(self, key):
+        value, deadline = self._data.get(key, (_MISSING, None))
+
+        if deadline is not None and deadline <= time.monotonic():
+            del self._data[key]
+            return _MISSING
+
+        return value
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._lookup(key) is not _MISSING
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = self._lookup(key)
+
+            if value is _MISSING:
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def peek(self, key, default=None):
+        # lookup without touching recency or statistics
+        with self._lock:
+            value = self._lookup(key)
+            return default if value is _MISSING else value
+
+    def put(self, key, value, ttl=None):
+        evicted = []
+
+        with self._lock:
+            self._data[key] = value, None if ttl is None else time.monotonic() + ttl
+            self._data.move_to_end(key)
+
+            while len(self._data) > self.maxsize:
+                k, (v, _) = self._data.popitem(last=False)
+                evicted.append((k, v))
+
+        if self.on_evict:
+            for item in evicted:
+                self.on_evict(*item)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            value = self._lookup(key)
+            self._data.pop(key, None)
+            return default if value is _MISSING else value
+
+    def keys(self):
+        with self._lock:
+            return list(self._data)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return dict(size=len(self._data), maxsize=self.maxsize, hits=self.hits, misses=self.misses)
+
+
+class VerdictCache:
+    """
+    Remembers the verdict of a submission by challenge and hash of its source code. Only line
+    endings are normalized, indentation and trailing spaces may change what a program does.
+    Verdicts of nondeterministic challenges expire after `ttl` seconds.
+    """
+
+    def __init__(self, maxsize=4096, ttl=300):
+        self.ttl = ttl
+        self.cache = LRUCache(maxsize)
+
+    @staticmethod
+    def key(name, code):
+        return name, hashlib.sha256(code.replace('\r\n', '\n').encode('utf-8')).hexdigest()
+
+    def get(self, name, code):
+        return self.cache.get(self.key(name, code))
+
+    def put(self, name, code, verdict, deterministic=True):
+        self.cache.put(self.key(name, code), verdict, None if deterministic else self.ttl)
+
+    def stats(self):
+        return self.cache.stats()
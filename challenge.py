@@ -1,39 +1,98 @@
 # Standard library modules.
 import os
+import re
 import abc
+import logging
 import telegram
 from collections import OrderedDict
 
 # Third party modules.
 
 # Local modules
-from util import sandboxed_exec, tts
+import media
+from util import Case
+from cache import VerdictCache
+from metrics import stats
+from submissions import SubmissionError, submissions
+from delivery import outbox
+from dispatch import offload
 
 # Globals and constants variables.
+system_log = logging.getLogger('das-system-log')
 
+# seconds a submission may run
+EXECUTION_TIMEOUT = 10
 
-class SubmissionError(Exception):
-    pass
+# failures caused by the load of the system rather than by the submission itself
+TRANSIENT_ERRORS = ('ExecutionTimeout', 'CPUTimeExceeded', 'WorkerCrash')
+
+verdicts = VerdictCache()
+
+_MARKDOWN_LINK = re.compile(r'\[[^\]]*\]\([^)]*\)')
 
 
 class ChallengeMeta(abc.ABCMeta):
+    """
+    Registers every challenge and assigns it a bit in the order of registration. Requirements
+    have to be registered before the challenges depending on them, so the registration order is
+    a topological order of the dependency graph and cycles can't occur.
+    """
     registry = OrderedDict()
+    prompts = {}
+    bits = {}
+    version = 0
 
     def __init__(cls, name, bases, namespace):
         if bases:
-            cls.registry[namespace.get('_name') or name] = cls
+            key = namespace.get('_name') or name
+            unknown = set(cls._requires) - set(cls.registry)
+
+            if unknown:
+                raise TypeError(f'challenge {key} requires unknown or cyclic challenges: {sorted(unknown)}')
+
+            cls._bit = cls.bits[key] = 1 << len(cls.registry)
+            cls._requires_mask = cls.mask(cls._requires)
+            cls.registry[key] = cls
+            ChallengeMeta.version += 1
+
+            # static prompts are compiled right away, generated ones on first use
+            if namespace.get('_prompt'):
+                cls.prompts[key] = check_markdown(namespace['_prompt'])
 
         super().__init__(name, bases, namespace)
 
+    def mask(cls, names):
+        # names which are not registered (anymore) are ignored
+        bits = cls.bits
+        return sum(bits[n] for n in set(names) if n in bits)
+
 
 class Challenge(metaclass=ChallengeMeta):
     _name = None
     _requires = set()
     _help = 'Für diese Challenge wird keine Hilfe zur Verfügung gestellt ¯\\_(ツ)_/¯'
+    _cases = ()
+    _deterministic = True
+    _voice = None
+    _prompt = None
 
-    def __init__(self, state):
-        self.unlocked = all(r in state.solved for r in self.requires)
-        self.solved = self.name in state.solved
+    def __init__(self, state, progress=None):
+        progress = self.progress(state) if progress is None else progress
+
+        self.unlocked = not self._requires_mask & ~progress
+        self.solved = bool(self._bit & progress)
+        self.results = []
+        self.error = None
+        self.transient = False
+
+    @classmethod
+    def progress(cls, state):
+        # bitmask of solved challenges
+        return cls.mask(state.solved)
+
+    @classmethod
+    def unlocked_mask(cls, progress):
+        return sum(c._bit for c in cls.registry.values() if not c._requires_mask & ~progress)
 
     @classmethod
     def load(cls, state):
@@ -41,15 +100,17 @@ class Challenge(metaclass=ChallengeMeta):
 
     @classmethod
     def list(cls, state, unlocked=None, solved=None):
-        challenges = (c(state) for c in cls.registry.values())
+        progress = cls.progress(state)
+        selected = ~0
 
         if unlocked is not None:
-            challenges = filter(lambda c: c.unlocked == unlocked, challenges)
+            mask = cls.unlocked_mask(progress)
+            selected &= mask if unlocked else ~mask
 
         if solved is not None:
-            challenges = filter(lambda c: c.solved == solved, challenges)
+            selected &= progress if solved else ~progress
 
-        return list(challenges)
+        return [c(state, progress) for c in cls.registry.values() if c._bit & selected]
 
     @property
     def name(self):
@@ -63,36 +124,104 @@ class Challenge(metaclass=ChallengeMeta):
     def help(self):
         return self._help
 
-    @abc.abstractmethod
+    @classmethod
+    def render_prompt(cls):
+        # overwrite for start messages which can't be given as static `_prompt`
+        return cls._prompt
+
+    @classmethod
+    def prompt(cls):
+        key = cls._name or cls.__name__
+
+        if key not in cls.prompts:
+            cls.prompts[key] = check_markdown(cls.render_prompt())
+
+        return cls.prompts[key]
+
     def start(self, update, context):
-        raise NotImplementedError
+        return self.prompt()
 
-    @abc.abstractmethod
-    def submit(self, update, context):
-        raise NotImplementedError
+    def cases(self):
+        # test table of the challenge, overwrite for randomized cases
+        return self._cases
+
+    @classmethod
+    def voices(cls):
+        # fixed texts spoken by challenges, rendered ahead of time
+        return [c._voice for c in cls.registry.values() if c._voice]
+
+    @property
+    def deterministic(self):
+        return self._deterministic
+
+    @property
+    def verdict(self):
+        return dict(solved=self.solved, results=self.results, error=self.error)
+
+    async def restore(self, update, context, verdict):
+        # replay a cached verdict as if the submission was executed again
+        self.solved, self.results, self.error = verdict['solved'], verdict['results'], verdict['error']
+
+        if self.error:
+            send_error(update, context, self.error)
+
+    async def execute(self, update, context, code, namespace=None, select=(), cases=()):
+        # includes the time spent waiting for the turn of the user and a worker
+        with stats.timer('das_execution_seconds', challenge=self.name):
+            state = await submissions.run(update, code, EXECUTION_TIMEOUT, namespace, select, cases)
+
+        usage = state.get('__USAGE__')
+        if usage:
+            stats.observe('das_sandbox_seconds', usage['wall'], challenge=self.name)
+            usage = f'cpu: {usage["cpu"]:.3f}s, wall: {usage["wall"]:.3f}s, peak rss: {usage["rss"] / 1024 ** 2:.1f}MiB'
+            system_log.info(f'executed code of {update.effective_user.username} ({usage})')
+
+        errors = [state['__EXCEPTION__']] + [(r['error'] or '').split(':')[0] for r in state['__CASES__']]
+        self.transient = any(e in TRANSIENT_ERRORS for e in errors)
 
+        if state.get('__EXCEPTION__'):
+            msg = state['__STDERR__']
 
-def extract_and_exec(update, context, namespace=None):
-    code = ''
+            if state.get('__TRUNCATED__'):
+                msg += '\n[Ausgabe gekürzt]'
+
+            if usage:
+                msg += f'\n\n{usage}'
+
+            self.error = msg
+            send_error(update, context, msg)
+
+        return state
+
+    async def submit(self, update, context, code):
+        self.results = (await self.execute(update, context, code, cases=self.cases()))['__CASES__']
+        self.solved = bool(self.results) and all(r['passed'] for r in self.results)
+
+
+async def extract_source(update):
     if update.message:
         if update.message.text:
-            code = update.message.text
+            return update.message.text
 
         elif update.message.document:
-            code = update.message.document.get_file().download_as_bytearray().decode('utf-8')
+            try:
+                return await offload(media.documents.text, update.message.document)
 
-    state = sandboxed_exec(code, 10, namespace)
+            except media.DocumentTooLarge:
+                raise SubmissionError(f'Die Datei ist zu groß, erlaubt sind {media.documents.max_bytes // 1024} KiB.')
 
-    if state.get('__EXCEPTION__'):
-        msg = state['__STDERR__']
+            except UnicodeDecodeError:
+                raise SubmissionError('Die Datei ist keine UTF-8 kodierte Textdatei.')
 
-        context.bot.send_message(
-            text=f'Da ist was schief gegangen o.O\n\n```\n{msg}\n```',
-            chat_id=update.effective_chat.id,
-            parse_mode=telegram.ParseMode.MARKDOWN
-        )
+    return ''
 
-    return state
+
+def send_error(update, context, msg):
+    outbox.send_message(
+        context.bot, update.effective_chat.id,
+        f'Da ist was schief gegangen o.O\n\n```\n{msg}\n```',
+        parse_mode=telegram.ParseMode.MARKDOWN
+    )
 
 
 def strip(s):
@@ -106,177 +235,175 @@ def strip_code(s):
     return '\n'.join(l[len(prefix):] for l in lines)
 
 
-class HelloWorld(Challenge):
-    def start(self, update, context):
-        return strip("""
-            Hey! Cool, dass du die deine erste Challenge angehen möchtest! Ich gehe davon
-            aus, dass du _Python3_ bereits auf deinem Computer installiert hast!? Wenn nicht
-            mach das bitte erst mal ;). Wenn du nur etwas herumstöbern willst, kann ich Dir
-            auch diese Website empfehlen: https://repl.it/languages/python3
-            
-            Wenn das geklappt hat, schreibe ein Programm, dass "hello world" ausgibt und
-            schicke mir das fertige Programm als Textnachricht oder Datei. Für die Ausgabe solltest
-            du die Funktion `print` benutzen ;)
-            
-            Viel Spaß 🦦!
-        """)
-
-    def submit(self, update, context):
-        state = extract_and_exec(update, context)
+def check_markdown(s):
+    """Raises a `ValueError` if `s` is no valid telegram markdown (the legacy flavour), i.e. an
+    entity is left open."""
+    i = 0
 
-        if 'hello world' in str(state.get('__STDOUT__')).strip().lower():
-            self.solved = True
+    while i < len(s):
+        if s[i] == '\\':
+            i += 2
+            continue
 
+        for token in ('```', '`', '*', '_'):
+            if s.startswith(token, i):
+                end = s.find(token, i + len(token))
 
-class LongestString(Challenge):
-    _requires = {'HelloWorld'}
+                if end < 0:
+                    raise ValueError(f'unclosed markdown entity "{token}" at: {s[i:i + 40]!r}')
 
-    def start(self, update, context):
-        return strip("""
-        So, jetz wo du so grob weißt, wie das hier läuft, habe ich eine etwas schwerere Aufgabe
-        für Dich!
+                i = end + len(token)
+                break
+
+        else:
+            link = _MARKDOWN_LINK.match(s, i)
+            i = link.end() if link else i + 1
 
-        Schreibe eine Funktion `longest_string`, die eine Liste mit Strings als Eingabe bekommt und
-        den längsten String zurück gibt. Gibt es mehrere längste Strings, gib den letzten zurück.
+    return s
 
-        Nutze den folgenden Codeschnipsel als Vorlage für dein Programm ;)
-        """) + '\n\n' + strip_code("""
-        ```
-        from typing import List
+
+class HelloWorld(Challenge):
+    _prompt = strip("""
+        Hey! Cool, dass du die deine erste Challenge angehen möchtest! Ich gehe davon
+        aus, dass du _Python3_ bereits auf deinem Computer installiert hast!? Wenn nicht
+        mach das bitte erst mal ;). Wenn du nur etwas herumstöbern willst, kann ich Dir
+        auch diese Website empfehlen: https://repl.it/languages/python3
         
-        def longest_string(l: List[str]) -> str:
-            raise NotImplementedError
+        Wenn das geklappt hat, schreibe ein Programm, dass "hello world" ausgibt und
+        schicke mir das fertige Programm als Textnachricht oder Datei. Für die Ausgabe solltest
+        du die Funktion `print` benutzen ;)
         
-        assert longest_string([]) == None
-        assert longest_string(['a']) == 'a'
-        assert longest_string(['a', 'b']) == 'b'
-        assert longest_string(['a', 'bb', 'c']) == 'bb'
-        ```
-        """)
+        Viel Spaß 🦦!
+    """)
 
-    def submit(self, update, context):
-        longest_string = extract_and_exec(update, context).get('longest_string')
+    async def submit(self, update, context, code):
+        state = await self.execute(update, context, code)
 
-        if longest_string:
-            try:
-                assert longest_string([]) is None
-                assert longest_string(['a']) == 'a'
-                assert longest_string(['a', 'b']) == 'b'
-                assert longest_string(['a', 'bb', 'c']) == 'bb'
-                self.solved = True
+        if 'hello world' in str(state.get('__STDOUT__')).strip().lower():
+            self.solved = True
 
-            except AssertionError:
-                pass
+
+class LongestString(Challenge):
+    _requires = {'HelloWorld'}
+    _cases = (
+        Case('longest_string([])', None, 'is'),
+        Case("longest_string(['a'])", 'a'),
+        Case("longest_string(['a', 'b'])", 'b'),
+        Case("longest_string(['a', 'bb', 'c'])", 'bb'),
+    )
+
+    _prompt = strip("""
+    So, jetz wo du so grob weißt, wie das hier läuft, habe ich eine etwas schwerere Aufgabe
+    für Dich!
+
+    Schreibe eine Funktion `longest_string`, die eine Liste mit Strings als Eingabe bekommt und
+    den längsten String zurück gibt. Gibt es mehrere längste Strings, gib den letzten zurück.
+
+    Nutze den folgenden Codeschnipsel als Vorlage für dein Programm ;)
+    """) + '\n\n' + strip_code("""
+    ```
+    from typing import List
+    
+    def longest_string(l: List[str]) -> str:
+        raise NotImplementedError
+    
+    assert longest_string([]) == None
+    assert longest_string(['a']) == 'a'
+    assert longest_string(['a', 'b']) == 'b'
+    assert longest_string(['a', 'bb', 'c']) == 'bb'
+    ```
+    """)
 
 
 class FizzBuzz(Challenge):
     _requires = {'HelloWorld'}
     _help = 'Der Modulo-Operator (%) kann bei dieser Aufgabe sehr nützlich sein.'
-
-    def start(self, update, context):
-        return strip("""
-        Schreibe eine Funktion `fizzbuzz`, die eine Zahl als Eingabe bekommt und "Fizz" zurück 
-        gibt, wenn die Zahl durch 3 teilbar ist. Ist die Zahl durch 5 teilbar, gibt sie "Buzz" 
-        zurück, bzw. "FizzBuzz", wenn beides zutrifft. In allen anderen Fällen, wird einfach die 
-        Zahl selbst zurück gegeben.
-        
-        Nutze den folgenden Codeschnipsel als Vorlage für dein Programm ;)
-        """) + '\n\n' + strip_code("""
-        ```
-        def fizzbuzz(x: int) -> str:
-            raise NotImplementedError
-        
-        assert fizzbuzz(2) == '2'
-        assert fizzbuzz(3) == 'Fizz'
-        assert fizzbuzz(5) == 'Buzz'
-        assert fizzbuzz(15) == 'FizzBuzz'
-        ```
-        """)
-
-    def submit(self, update, context):
-        fizzbuzz = extract_and_exec(update, context).get('fizzbuzz')
-
-        if fizzbuzz:
-            try:
-                assert str(fizzbuzz(2)) == '2'
-                assert str(fizzbuzz(3)) == 'Fizz'
-                assert str(fizzbuzz(5)) == 'Buzz'
-                assert str(fizzbuzz(6)) == 'Fizz'
-                assert str(fizzbuzz(15)) == 'FizzBuzz'
-                assert str(fizzbuzz(1515)) == 'FizzBuzz'
-                self.solved = True
-
-            except AssertionError:
-                pass
+    _cases = (
+        Case('fizzbuzz(2)', '2', 'str'),
+        Case('fizzbuzz(3)', 'Fizz', 'str'),
+        Case('fizzbuzz(5)', 'Buzz', 'str'),
+        Case('fizzbuzz(6)', 'Fizz', 'str'),
+        Case('fizzbuzz(15)', 'FizzBuzz', 'str'),
+        Case('fizzbuzz(1515)', 'FizzBuzz', 'str'),
+    )
+
+    _prompt = strip("""
+    Schreibe eine Funktion `fizzbuzz`, die eine Zahl als Eingabe bekommt und "Fizz" zurück 
+    gibt, wenn die Zahl durch 3 teilbar ist. Ist die Zahl durch 5 teilbar, gibt sie "Buzz" 
+    zurück, bzw. "FizzBuzz", wenn beides zutrifft. In allen anderen Fällen, wird einfach die 
+    Zahl selbst zurück gegeben.
+    
+    Nutze den folgenden Codeschnipsel als Vorlage für dein Programm ;)
+    """) + '\n\n' + strip_code("""
+    ```
+    def fizzbuzz(x: int) -> str:
+        raise NotImplementedError
+    
+    assert fizzbuzz(2) == '2'
+    assert fizzbuzz(3) == 'Fizz'
+    assert fizzbuzz(5) == 'Buzz'
+    assert fizzbuzz(15) == 'FizzBuzz'
+    ```
+    """)
 
 
 class Palindrome(Challenge):
     _requires = {'LongestString', 'FizzBuzz'}
     _help = 'Groß- und Kleinschreibung soll ignoriert werden ("Ö" == "ö" usw.)'
-
-    def start(self, update, context):
-        return strip("""
-        Ein Palindrom ist ein Wort, das vorwärts und rückwärts gelesen werden kann wie z.B. 
-        "Otto" oder "Regallager". Schreibe eine Funktion, die `True` zurück gibt, wenn das gegebene 
-        Wort ein Palindrom ist.
-
-        Nutze den folgenden Codeschnipsel als Vorlage für dein Programm ;)
-        """) + '\n\n' + strip_code("""
-        ```
-        def palindrome(s: str) -> bool:
-            raise NotImplementedError
-        ```
-        """)
-
-    def submit(self, update, context):
-        palindrome = extract_and_exec(update, context).get('palindrome')
-
-        if palindrome:
-            try:
-                assert palindrome('') == True
-                assert palindrome('Abba') == True
-                assert palindrome('a'*100 + 'b' + 'a'*100) == True
-                assert palindrome('a'*100 + 'b' + 'a'*101) == False
-                self.solved = True
-
-            except AssertionError:
-                pass
+    _cases = (
+        Case("palindrome('')", True),
+        Case("palindrome('Abba')", True),
+        Case("palindrome('a'*100 + 'b' + 'a'*100)", True),
+        Case("palindrome('a'*100 + 'b' + 'a'*101)", False),
+    )
+
+    _prompt = strip("""
+    Ein Palindrom ist ein Wort, das vorwärts und rückwärts gelesen werden kann wie z.B. 
+    "Otto" oder "Regallager". Schreibe eine Funktion, die `True` zurück gibt, wenn das gegebene 
+    Wort ein Palindrom ist.
+
+    Nutze den folgenden Codeschnipsel als Vorlage für dein Programm ;)
+    """) + '\n\n' + strip_code("""
+    ```
+    def palindrome(s: str) -> bool:
+        raise NotImplementedError
+    ```
+    """)
 
 
 class CaesarI(Challenge):
     _requires = {'Palindrome'}
 
-    def start(self, update, context):
-        return strip("""
-        Schon die alten Römer kannten das Prinzip der Verschlüsselung. Verglichen mit heutigen
-        Methoden war sie allerdings nicht besonders sicher und kann mit heutigen Mitteln leicht
-        geknackt werden. Heute ist diese Verschlüsselung unter dem Namen _Caesar-Verschlüsselung_
-        bekannt.
-        
-        Bei der _Caesar-Verschlüsselung_ wird zum Verschlüsseln jeder Buchstabe eines Textes um _x_,
-        zum Entschlüsseln um _-x_ Stellen verschoben. Z.B.: `caesar('a', 2) -> 'c'`,
-        `caesar('z', 2) -> 'b'` oder `caesar(caesar('abc', 9999), -9999) -> 'abc'`.
-        
-        Der folgende Satz wurde mit dem Schlüssel *1337* verschlüsselt. Schicke mir den 
-        entschlüsselten Text zurück!
-        
-        *"Qlmpc pde dflp bftdbfp qzcefylp."*
-        
-        _Tipps_
-        
-        Alles zeichen, die keine Buchstaben des Englischen Alphabets sind, werden bei der 
-        Verschlüsselung ignoriert.
-        
-        Der ASCII-Standart legt die Kodierung von Zeichen als Zahlen fest. Der Zahlenbereich 65-90
-        enthält die Groß-, der Bereich 97-122 die Kleinbuchstaben (siehe https://www.ascii-code.com).
-        Mit der Python-Funktion `ord` kannst du ein Zeichen in den Entsprechenden ASCII-Code
-        umwandeln und mit `chr` einen ASCII-Code zu dem entsprechenden Zeichen.
-        
-        Der Modulo-Operator `%` wird benutzt, um den Rest einer Division zu berechnen, z.B. 
-        `5 % 3 ->2` oder `10 % 2 -> 0`.
-        """)
-
-    def submit(self, update, context):
+    _prompt = strip("""
+    Schon die alten Römer kannten das Prinzip der Verschlüsselung. Verglichen mit heutigen
+    Methoden war sie allerdings nicht besonders sicher und kann mit heutigen Mitteln leicht
+    geknackt werden. Heute ist diese Verschlüsselung unter dem Namen _Caesar-Verschlüsselung_
+    bekannt.
+    
+    Bei der _Caesar-Verschlüsselung_ wird zum Verschlüsseln jeder Buchstabe eines Textes um _x_,
+    zum Entschlüsseln um _-x_ Stellen verschoben. Z.B.: `caesar('a', 2) -> 'c'`,
+    `caesar('z', 2) -> 'b'` oder `caesar(caesar('abc', 9999), -9999) -> 'abc'`.
+    
+    Der folgende Satz wurde mit dem Schlüssel *1337* verschlüsselt. Schicke mir den 
+    entschlüsselten Text zurück!
+    
+    *"Qlmpc pde dflp bftdbfp qzcefylp."*
+    
+    _Tipps_
+    
+    Alles zeichen, die keine Buchstaben des Englischen Alphabets sind, werden bei der 
+    Verschlüsselung ignoriert.
+    
+    Der ASCII-Standart legt die Kodierung von Zeichen als Zahlen fest. Der Zahlenbereich 65-90
+    enthält die Groß-, der Bereich 97-122 die Kleinbuchstaben (siehe https://www.ascii-code.com).
+    Mit der Python-Funktion `ord` kannst du ein Zeichen in den Entsprechenden ASCII-Code
+    umwandeln und mit `chr` einen ASCII-Code zu dem entsprechenden Zeichen.
+    
+    Der Modulo-Operator `%` wird benutzt, um den Rest einer Division zu berechnen, z.B. 
+    `5 % 3 ->2` oder `10 % 2 -> 0`.
+    """)
+
+    async def submit(self, update, context, code):
         if update.message:
             if update.message.text:
                 try:
@@ -290,127 +417,103 @@ class CaesarI(Challenge):
 class CaesarII(Challenge):
     _requires = {'CaesarI'}
     _help = 'Mit moderner Rechenpower ist es kein Problem, den Schlüssel zu erraten.'
+    _voice = 'Ach du Scheiße, ich habe Teile meines eigenen Quellcodes verschlüsselt. ' \
+             'Kriegst du das geknackt?'
 
-    def start(self, update, context):
+    @classmethod
+    def render_prompt(cls):
         import inspect
         from solutions import caesar
 
-        msg = 'Ach du Scheiße, ich habe Teile meines eigenen Quellcodes verschlüsselt. ' \
-              'Kriegst du das geknackt?'
+        return f'```\n{caesar(inspect.getsource(OutsideTheBox), 13)}\n```'
 
-        with tts(msg) as buffer:
-            context.bot.send_voice(chat_id=update.effective_chat.id, voice=buffer)
+    def start(self, update, context):
+        media.speak(context.bot, update.effective_chat.id, self._voice)
 
-        return f'```\n{caesar(inspect.getsource(OutsideTheBox), 13)}\n```'
+        return self.prompt()
+
+    async def submit(self, update, context, code):
+        state = await self.execute(update, context, code, namespace={'Challenge': type}, select=('OutsideTheBox',))
 
-    def submit(self, update, context):
-        if 'OutsideTheBox' in extract_and_exec(update, context, namespace={'Challenge': type}):
+        if 'OutsideTheBox' in state:
             self.solved = True
 
 
 class Classes(Challenge):
     _requires = {'CaesarII'}
-
-    def start(self, update, context):
-        return strip("""
-        Hast du schon mal von Klassen in Python gehört? Klassen sind ein Konzept um Daten und die
-        zugehörige Logik zu koppeln. Gleichzeitig helfen sie, bestehenden Code wieder zu verwenden.
-
-        Du siehst hier teile meiner Geometrielogik. Kannst du den Code bitte fertig schreiben?
-        """) + '\n\n' + strip_code("""
-        ```
-        class Shape:
-            def __init__(self, x: float, y: float):
-                self.x = x
-                self.y = y
-        
-            def __str__(self):
-                return f'{type(self).__name__}(pos={(self.x, self.y)}, area={self.area()})'
-        
-            def area(self):
-                # compute area of shape, has to be overwritten by subclasses
-                raise NotImplementedError
-        
-        
-        class Rectangle(Shape):
-            def __init__(self, x: float, y: float, h: float, w: float):
-                raise NotImplementedError
-        
-            def area(self):
-                raise NotImplementedError
-        
-        
-        class Square(Rectangle):
-            def __init__(self, x: float, y: float, l: float):
-                super().__init__(x, y, l, l)
-        
-        
-        class Circle(Shape):
-            def __init__(self, x: float, y: float, r: float):
-                raise NotImplementedError
-        
-            def area(self):
-                raise NotImplementedError
-            
+    _cases = (
+        Case('Rectangle(0, 0, 13, 37).area()', 481),
+        Case('Square(5, 13, 666).area()', 443556),
+        Case('Circle(-3, 2.5, 4.2).area()', 55.4178, 'approx'),
+    )
+
+    _prompt = strip("""
+    Hast du schon mal von Klassen in Python gehört? Klassen sind ein Konzept um Daten und die
+    zugehörige Logik zu koppeln. Gleichzeitig helfen sie, bestehenden Code wieder zu verwenden.
+
+    Du siehst hier teile meiner Geometrielogik. Kannst du den Code bitte fertig schreiben?
+    """) + '\n\n' + strip_code("""
+    ```
+    class Shape:
+        def __init__(self, x: float, y: float):
+            self.x = x
+            self.y = y
+    
+        def __str__(self):
+            return f'{type(self).__name__}(pos={(self.x, self.y)}, area={self.area()})'
+    
+        def area(self):
+            # compute area of shape, has to be overwritten by subclasses
+            raise NotImplementedError
+    
+    
+    class Rectangle(Shape):
+        def __init__(self, x: float, y: float, h: float, w: float):
+            raise NotImplementedError
+    
+        def area(self):
+            raise NotImplementedError
+    
+    
+    class Square(Rectangle):
+        def __init__(self, x: float, y: float, l: float):
+            super().__init__(x, y, l, l)
+    
+    
+    class Circle(Shape):
+        def __init__(self, x: float, y: float, r: float):
+            raise NotImplementedError
+    
+        def area(self):
+            raise NotImplementedError
         
-        print(Rectangle(0, 0, 1, 5))
-        print(Square(5, 10, 4))
-        print(Circle(-3, 2.5, 1.0))
-        ```
-        """)
-
-    def submit(self, update, context):
-        state = extract_and_exec(update, context)
-
-        Rectangle = state.get('Rectangle')
-        Square = state.get('Square')
-        Circle = state.get('Circle')
-
-        if Rectangle and Square and Circle:
-            try:
-                r = Rectangle(0, 0, 13, 37)
-                s = Square(5, 13, 666)
-                c = Circle(-3, 2.5, 4.2)
-
-                assert r.area() == 481
-                assert s.area() == 443556
-                assert abs(c.area() - 55.4178) < .001
-                self.solved = True
-
-            except AssertionError:
-                pass
+    
+    print(Rectangle(0, 0, 1, 5))
+    print(Square(5, 10, 4))
+    print(Circle(-3, 2.5, 1.0))
+    ```
+    """)
 
 
 class OutsideTheBox(Challenge):
     _requires = {'CaesarII', 'Classes'}
     _help = 'CaesarII'
+    _deterministic = False
 
     def start(self, update, context):
         # TODO write challenge description
         raise NotImplementedError
 
-    def submit(self, update, context):
+    def cases(self):
         from random import randint
 
-        # extract source code and execute it
-        state = extract_and_exec(update, context)
-
-        # extract target function
-        blackbox = state.get('blackbox')
-
-        # test target function
-        if blackbox is not None:
-            try:
-                n = randint(10, 1000)
+        n = randint(10, 1000)
 
-                assert blackbox('') == True
-                assert blackbox('abc') == True
-                assert blackbox('a' * n + 'b' * n) == True
-                assert blackbox('a' * n + 'b' * n + 'c' * (n+10)) == False
-                assert blackbox('system') == False
-                assert blackbox('fish') == True
-
-                self.solved = True
-
-            except AssertionError:
-                pass
+        return (
+            Case("blackbox('')", True),
+            Case("blackbox('abc')", True),
+            Case(f"blackbox('a' * {n} + 'b' * {n})", True),
+            Case(f"blackbox('a' * {n} + 'b' * {n} + 'c' * {n + 10})", False),
+            Case("blackbox('system')", False),
+            Case("blackbox('fish')", True),
+        )
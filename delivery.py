@@ -0,0 +1,258 @@
+# Standard library modules.
+import time
+import logging
+import threading
+from functools import partial
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# Third party modules.
+from telegram.error import RetryAfter
+
+# Local modules
+from cache import LRUCache
+from metrics import stats
+
+# Globals and constants variables.
+system_log = logging.getLogger('das-system-log')
+
+INTERACTIVE, BACKGROUND = 0, 1
+PRIORITIES = 'interactive', 'background'
+
+# telegram rejects longer texts
+MAX_LENGTH = 4096
+
+
+class TokenBucket:
+    """Allows `rate` events per second on average and bursts of up to `burst` events."""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.time = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + max(0., now - self.time) * self.rate)
+        self.time = max(self.time, now)
+
+    def delay(self, now):
+        """Seconds until the next event is allowed."""
+        self._refill(now)
+        return max(0., (1 - self.tokens) / self.rate)
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def pause(self, seconds, now):
+        self._refill(now)
+        self.tokens = min(self.tokens, 1) - seconds * self.rate
+
+
+class _Item:
+    __slots__ = 'func', 'name', 'kwargs', 'text', 'priority', 'futures'
+
+    def __init__(self, func, name, kwargs, priority, text=None):
+        self.func = func
+        self.name = name
+        self.kwargs = kwargs
+        self.text = text
+        self.priority = priority
+        self.futures = [(time.monotonic(), Future())]
+
+    @property
+    def created(self):
+        return self.futures[0][0]
+
+    def merge(self, other):
+        """Appends the text of `other` if both are texts sent the same way, returns whether it did."""
+        mergeable = (
+            self.text is not None and other.text is not None
+            and self.func == other.func and self.kwargs == other.kwargs
+            and len(self.text) + len(other.text) + 2 <= MAX_LENGTH
+        )
+
+        if mergeable:
+            self.text = f'{self.text}\n\n{other.text}'
+            self.priority = min(self.priority, other.priority)
+            self.futures += other.futures
+
+        return mergeable
+
+    def __call__(self):
+        return self.func(**self.kwargs) if self.text is None else self.func(text=self.text, **self.kwargs)
+
+
+class Outbox:
+    """
+    Sends everything the bot says through one queue per chat. Chats are served in order of the
+    priority of their next message, `INTERACTIVE` replies go before `BACKGROUND` ones such as
+    voice messages. At most `rate` messages per second are sent in total and `chat_rate` per chat,
+    with bursts of up to `burst` messages. Texts for the same chat queued within `window` seconds
+    are sent as one message. A chat telegram asks to slow down (`429`) is paused as long as told.
+    """
+
+    def __init__(self, rate=30., chat_rate=1., burst=3, window=.05, workers=4):
+        self.rate = rate
+        self.chat_rate = chat_rate
+        self.burst = burst
+        self.window = window
+        self.workers = workers
+
+        self.queues = {}
+        self.busy = set()
+        self.buckets = LRUCache(4096)
+        self.bucket = None
+        self.pool = None
+        self.condition = threading.Condition()
+
+    def configure(self, rate=None, chat_rate=None, burst=None, window=None, workers=None):
+        with self.condition:
+            if self.pool is not None:
+                raise RuntimeError('outbox is already running')
+
+            self.rate = rate or self.rate
+            self.chat_rate = chat_rate or self.chat_rate
+            self.burst = burst or self.burst
+            self.window = self.window if window is None else window
+            self.workers = workers or self.workers
+
+    def _start(self):
+        self.bucket = TokenBucket(self.rate, self.rate)
+        self.pool = ThreadPoolExecutor(self.workers, thread_name_prefix='outbox')
+        threading.Thread(target=self._schedule, name='outbox', daemon=True).start()
+
+    def depth(self):
+        with self.condition:
+            return sum(len(q) for q in self.queues.values())
+
+    def send_message(self, bot, chat_id, text, priority=INTERACTIVE, **kwargs):
+        """Queues a text for `chat_id`, returns a future of the sent message."""
+        return self._put(chat_id, _Item(bot.send_message, 'send_message', dict(chat_id=chat_id, **kwargs),
+                                        priority, text))
+
+    def call(self, chat_id, func, *args, priority=INTERACTIVE, **kwargs):
+        """Queues any other call sending to `chat_id`, e.g. of a voice message, returns a future of
+        its result."""
+        return self._put(chat_id, _Item(partial(func, *args), func.__name__, kwargs, priority))
+
+    def _put(self, chat_id, item):
+        with self.condition:
+            if self.pool is None:
+                self._start()
+
+            self.queues.setdefault(chat_id, deque()).append(item)
+            self.condition.notify_all()
+
+        return item.futures[0][1]
+
+    def _chat_bucket(self, chat_id):
+        bucket = self.buckets.get(chat_id)
+
+        # a bucket evicted for being idle was full anyway
+        if bucket is None:
+            bucket = TokenBucket(self.chat_rate, self.burst)
+            self.buckets.put(chat_id, bucket)
+
+        return bucket
+
+    def _next(self, now):
+        # returns the chat to serve next, or `None` and how long to wait for one
+        best, wait = None, None
+
+        for chat_id, items in self.queues.items():
+            if chat_id in self.busy:
+                continue
+
+            delay = max(items[0].created + self.window - now, self._chat_bucket(chat_id).delay(now))
+
+            if delay > 0:
+                wait = delay if wait is None else min(wait, delay)
+
+            elif best is None or (items[0].priority, items[0].created) < best[0]:
+                best = (items[0].priority, items[0].created), chat_id
+
+        if best is None:
+            return None, wait
+
+        delay = self.bucket.delay(now)
+        if delay > 0:
+            return None, delay
+
+        return best[1], None
+
+    def _schedule(self):
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                chat_id, wait = self._next(now)
+
+                if chat_id is None:
+                    self.condition.wait(wait)
+                    continue
+
+                items = self.queues[chat_id]
+                item = items.popleft()
+
+                while items and item.merge(items[0]):
+                    items.popleft()
+                    stats.inc('das_outbox_messages_total', result='coalesced')
+
+                if not items:
+                    del self.queues[chat_id]
+
+                self.bucket.take(now)
+                self._chat_bucket(chat_id).take(now)
+                self.busy.add(chat_id)
+
+                self.pool.submit(self._send, chat_id, item)
+
+    def _send(self, chat_id, item):
+        try:
+            with stats.timer('das_telegram_seconds', method=item.name):
+                result = item()
+
+        except RetryAfter as error:
+            system_log.warning(f'telegram asked to pause chat {chat_id} for {error.retry_after}s')
+            stats.inc('das_outbox_messages_total', result='retried')
+
+            # the message goes first once the chat may be served again
+            with self.condition:
+                self._chat_bucket(chat_id).pause(error.retry_after, time.monotonic())
+                self.queues.setdefault(chat_id, deque()).appendleft(item)
+                self.busy.discard(chat_id)
+                self.condition.notify_all()
+
+            return
+
+        except Exception as error:
+            system_log.warning(f'could not {item.name} to {chat_id}: {error!r}')
+            stats.inc('das_outbox_messages_total', result='failed')
+
+            for _, future in item.futures:
+                future.set_exception(error)
+
+        else:
+            now = time.monotonic()
+            stats.inc('das_outbox_messages_total', result='sent')
+
+            for created, future in item.futures:
+                stats.observe('das_outbox_seconds', now - created, priority=PRIORITIES[item.priority])
+                future.set_result(result)
+
+        with self.condition:
+            self.busy.discard(chat_id)
+            self.condition.notify_all()
+
+    def close(self, timeout_=10):
+        """Waits until everything queued was sent."""
+        with self.condition:
+            if self.pool is None:
+                return
+
+            if not self.condition.wait_for(lambda: not self.queues and not self.busy, timeout_):
+                system_log.warning(f'dropped {sum(len(q) for q in self.queues.values())} outgoing messages')
+
+
+outbox = Outbox()
@@ -0,0 +1,124 @@
+# Standard library modules.
+import asyncio
+import logging
+import threading
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+# Third party modules.
+import telegram
+from telegram.ext import CallbackContext, TypeHandler
+
+# Local modules
+
+# Globals and constants variables.
+system_log = logging.getLogger('das-system-log')
+
+
+async def offload(func, *args, **kwargs):
+    """Awaits a blocking call, e.g. to the telegram api, on the thread pool of the running loop."""
+    return await asyncio.get_running_loop().run_in_executor(None, partial(func, *args, **kwargs))
+
+
+class AsyncDispatcher:
+    """
+    Runs coroutine handlers on an asyncio event loop in a thread of its own. The dispatcher of
+    `telegram.ext` only hands the updates over, so a conversation waiting for the telegram api, a
+    code execution or a voice message doesn't occupy a thread. Blocking calls are passed to a
+    pool of `workers` threads via :func:`offload`. At most `max_tasks` updates are handled at a
+    time, further ones wait in front of the dispatcher.
+    """
+
+    def __init__(self, dispatcher, workers=8, max_tasks=1000):
+        self.dispatcher = dispatcher
+        self.handlers = []
+        self.tasks = set()
+        self.slots = threading.BoundedSemaphore(max_tasks)
+
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix='offload')
+        self.loop = asyncio.new_event_loop()
+        self.loop.set_default_executor(self.executor)
+        self.thread = threading.Thread(target=self.loop.run_forever, name='event-loop', daemon=True)
+
+        dispatcher.add_handler(TypeHandler(telegram.Update, self._schedule))
+
+    def add_handler(self, handler):
+        """Adds a handler of `telegram.ext` whose callback is a coroutine function, the first
+        handler matching an update handles it."""
+        self.handlers.append(handler)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def depth(self):
+        """Number of updates whose handlers didn't finish yet."""
+        return len(self.tasks)
+
+    def put(self, update):
+        """Hands an update over from any thread but the one of the loop, e.g. one not received by
+        `telegram.ext`. Blocks while `max_tasks` updates are handled."""
+        self.slots.acquire()
+        self.loop.call_soon_threadsafe(self._spawn, update)
+
+    def drain(self, timeout_=30):
+        """Waits up to `timeout_` seconds until the handlers of all updates handed over so far
+        finished."""
+        async def _drain():
+            if not self.tasks:
+                return 0
+
+            _, pending = await asyncio.wait(set(self.tasks), timeout=timeout_)
+            return len(pending)
+
+        future = asyncio.run_coroutine_threadsafe(_drain(), self.loop)
+
+        try:
+            # the loop itself might be blocked, a second of slack for answering in time otherwise
+            pending = future.result(timeout_ + 1)
+
+        except FutureTimeout:
+            future.cancel()
+            pending = len(self.tasks)
+
+        if pending:
+            system_log.warning(f'{pending} handlers did not finish in time')
+
+    def stop(self, timeout_=30):
+        self.drain(timeout_)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+        self.executor.shutdown()
+        self.loop.close()
+
+    def _schedule(self, update, context):
+        # runs on the thread of the `telegram.ext` dispatcher
+        self.put(update)
+
+    def _spawn(self, update):
+        task = self.loop.create_task(self._dispatch(update))
+        self.tasks.add(task)
+        task.add_done_callback(self._done)
+
+    def _done(self, task):
+        self.tasks.discard(task)
+        self.slots.release()
+
+    async def _dispatch(self, update):
+        for handler in self.handlers:
+            check = handler.check_update(update)
+
+            if check is None or check is False:
+                continue
+
+            context = CallbackContext.from_update(update, self.dispatcher)
+            handler.collect_additional_context(context, update, self.dispatcher, check)
+
+            try:
+                await handler.callback(update, context)
+
+            except Exception as error:
+                system_log.error(f'{handler.callback.__name__} failed: {error!r}', exc_info=error)
+
+            return
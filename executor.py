@@ -0,0 +1,233 @@
+# Standard library modules.
+import os
+import queue
+import pickle
+import signal
+import importlib
+import threading
+import multiprocessing
+from functools import partial
+from concurrent.futures import Future
+from multiprocessing.connection import wait
+
+# Third party modules.
+
+# Local modules
+from util import FORK_LOCK, MAX_OUTPUT, sandboxed_exec, resource_limits, reset_peak_rss
+from profiling import profiler, record
+
+# Globals and constants variables.
+PRELOAD = ('typing', 'collections', 'functools', 'itertools', 'math', 'random', 'string', 're')
+
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+
+def _export(state, select):
+    result = dict(
+        __STDOUT__=state['__STDOUT__'],
+        __STDERR__=state['__STDERR__'],
+        __EXCEPTION__=state['__EXCEPTION__'] and state['__EXCEPTION__'].__name__,
+        __TRUNCATED__=state['__TRUNCATED__'],
+        __USAGE__=state['__USAGE__'],
+        __CASES__=state['__CASES__'],
+    )
+
+    for name in select:
+        if name in state:
+            try:
+                result[name] = pickle.loads(pickle.dumps(state[name]))
+
+            except Exception:
+                # objects defined by the submission can't leave the worker, report their presence
+                result[name] = None
+
+    return result
+
+
+def _worker(conn, limits):
+    # shutdown is up to the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    while True:
+        try:
+            job = conn.recv()
+
+        except EOFError:
+            return
+
+        if job is None:
+            return
+
+        code, timeout_, namespace, select, cases, profile = job
+        run = partial(sandboxed_exec, code, timeout_, namespace, limits['output'], cases)
+
+        reset_peak_rss()
+        with resource_limits(limits['cpu'], limits['memory']):
+            if profile is None:
+                state = run()
+            else:
+                path, top = profile
+                state = record(path, 'sandboxed_exec', top, run)
+
+        conn.send(_export(state, select))
+
+
+def _failure(error, msg):
+    return dict(
+        __STDOUT__='', __STDERR__=msg, __EXCEPTION__=error,
+        __TRUNCATED__=False, __USAGE__=None, __CASES__=[],
+    )
+
+
+class WorkerPool:
+    """
+    Executes code in `size` pre-forked worker processes. Each worker serves one job at a time
+    and is replaced after `max_jobs` jobs, after a crash or if it exceeds the timeout of a job
+    by more than `grace` seconds. A job may use `cpu_limit` seconds of cpu time, allocate
+    `memory_limit` bytes of address space and write `max_output` bytes per output stream.
+    """
+
+    def __init__(self, size=None, max_jobs=100, grace=1., max_output=MAX_OUTPUT,
+                 cpu_limit=None, memory_limit=None):
+        self.size = size or os.cpu_count() or 1
+        self.max_jobs = max_jobs
+        self.grace = grace
+        self.limits = dict(output=max_output, cpu=cpu_limit, memory=memory_limit)
+
+        self.context = multiprocessing.get_context('fork')
+        self.jobs = queue.Queue()
+        self.slots = [threading.Thread(target=self._slot, name=f'executor-{i}', daemon=True)
+                      for i in range(self.size)]
+
+    def start(self):
+        # workers inherit everything imported so far
+        for module in PRELOAD:
+            importlib.import_module(module)
+
+        for slot in self.slots:
+            slot.start()
+
+        return self
+
+    def shutdown(self):
+        for _ in self.slots:
+            self.jobs.put(None)
+
+        for slot in self.slots:
+            slot.join()
+
+    def submit(self, code, timeout_=None, namespace=None, select=(), cases=(), profile=None):
+        """`profile` is a `(path, top)` pair passed to :func:`profiling.record` or `None`."""
+        future = Future()
+        self.jobs.put(((code, timeout_, namespace, tuple(select), tuple(cases), profile), future))
+        return future
+
+    def _spawn(self):
+        conn, child = self.context.Pipe()
+        process = self.context.Process(target=_worker, args=(child, self.limits), daemon=True)
+
+        with FORK_LOCK:
+            process.start()
+
+        child.close()
+
+        return process, conn
+
+    @staticmethod
+    def _retire(process, conn, kill=False):
+        if kill:
+            process.kill()
+        else:
+            try:
+                conn.send(None)
+
+            except OSError:
+                process.kill()
+
+        process.join()
+        conn.close()
+
+    def _slot(self):
+        process, conn = self._spawn()
+        served = 0
+
+        while True:
+            item = self.jobs.get()
+
+            if item is None:
+                break
+
+            job, future = item
+
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            timeout_, broken = job[1], False
+
+            try:
+                conn.send(job)
+
+                # other workers hold copies of the pipe, so a dying worker doesn't imply EOF
+                ready = wait([conn, process.sentinel], timeout_ + self.grace if timeout_ else None)
+
+                if conn in ready:
+                    result = conn.recv()
+                elif ready:
+                    raise EOFError
+                else:
+                    broken = True
+                    result = _failure('ExecutionTimeout', f'code execution took longer than {timeout_:.3f}s '
+                                                          f'to terminate and was aborted')
+
+            except (EOFError, OSError):
+                broken = True
+                result = _failure('WorkerCrash', 'code execution aborted, the worker process died')
+
+            except Exception as error:
+                # e.g. a namespace that can't be pickled, the worker itself is fine
+                future.set_exception(error)
+                continue
+
+            served += 1
+
+            # replace the worker right away, so the next job finds a warm one
+            if broken or served >= self.max_jobs:
+                self._retire(process, conn, kill=broken)
+                process, conn = self._spawn()
+                served = 0
+
+            future.set_result(result)
+
+        self._retire(process, conn)
+
+
+def start(size=None, max_jobs=100, **limits):
+    global _POOL
+
+    with _POOL_LOCK:
+        if _POOL is None:
+            _POOL = WorkerPool(size, max_jobs, **limits).start()
+
+        return _POOL
+
+
+def shutdown():
+    global _POOL
+
+    with _POOL_LOCK:
+        if _POOL is not None:
+            _POOL.shutdown()
+            _POOL = None
+
+
+def queue_depth():
+    """Number of jobs waiting for a free worker."""
+    return _POOL.jobs.qsize() if _POOL is not None else 0
+
+
+def submit(code, timeout_=None, namespace=None, select=(), cases=()):
+    """Like :func:`util.sandboxed_exec`, but runs in a worker process. Returns a future of the
+    captured output, the exception name, the case results, the resource usage and the globals
+    listed in `select`."""
+    return start().submit(code, timeout_, namespace, select, cases, profiler.target())
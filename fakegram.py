@@ -0,0 +1,263 @@
+# Standard library modules.
+import json
+import time
+import hashlib
+import queue
+import threading
+import urllib.error
+import urllib.request
+import email.policy
+import email.parser
+from urllib.parse import parse_qsl
+from collections import defaultdict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Third party modules.
+
+# Local modules
+
+# Globals and constants variables.
+BOT = dict(id=1, is_bot=True, first_name='das System', username='das_system_bot')
+
+
+def _params(content_type, body):
+    if not body:
+        return {}
+
+    if content_type.startswith('application/json'):
+        return json.loads(body)
+
+    if content_type.startswith('multipart/form-data'):
+        message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+            b'Content-Type: ' + content_type.encode('latin-1') + b'\r\n\r\n' + body
+        )
+
+        # uploaded files are dropped, only their presence matters
+        return {
+            part.get_param('name', header='content-disposition'):
+                part.get_content() if part.get_filename() is None else part.get_filename()
+            for part in message.iter_parts()
+        }
+
+    return dict(parse_qsl(body.decode('utf-8')))
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _file(self):
+        content = self.server.download(self.path.rsplit('/', 1)[-1])
+        status = 200 if content is not None else 404
+
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(content or b'')))
+        self.end_headers()
+        self.wfile.write(content or b'')
+
+    def _handle(self):
+        if self.path.startswith('/file/'):
+            return self._file()
+
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        method = self.path.split('?')[0].rsplit('/', 1)[-1]
+        params = _params(self.headers.get('Content-Type', ''), body)
+
+        try:
+            result = dict(ok=True, result=self.server.call(method, params))
+            status = 200
+
+        except KeyError:
+            result = dict(ok=False, error_code=404, description='Not Found')
+            status = 404
+
+        payload = json.dumps(result).encode('utf-8')
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    do_GET = do_POST = _handle
+
+
+class FakeTelegram(ThreadingHTTPServer):
+    """
+    Local stand-in for the parts of the telegram bot api the bot uses. Updates are injected with
+    :meth:`send` or :meth:`send_document` and served via long polling or, once a webhook is set, posted to it in batches of
+    up to `batch_size`. Everything the bot sends ends up in the per chat queues of `replies` as
+    `(time, params)`. Documents are served below :attr:`file_url`, `downloads` counts how often.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0), batch_size=100):
+        super().__init__(address, _Handler)
+
+        self.batch_size = batch_size
+        self.webhook = None
+        self.updates = []
+        self.update_id = 0
+        self.message_id = 0
+        self.ready = threading.Event()
+        self.condition = threading.Condition()
+        self.replies = defaultdict(queue.Queue)
+        self.files = {}
+        self.downloads = 0
+
+        self.methods = dict(
+            getMe=lambda params: BOT,
+            setWebhook=self.set_webhook,
+            deleteWebhook=self.delete_webhook,
+            getUpdates=self.get_updates,
+            getFile=self.get_file,
+            sendMessage=self.reply,
+            sendVoice=self.reply,
+            sendDocument=self.reply,
+            sendChatAction=lambda params: True,
+        )
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}/bot'
+
+    @property
+    def file_url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}/file/bot'
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name='fakegram', daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def call(self, method, params):
+        return self.methods[method](params)
+
+    def _message(self, chat_id, user, **content):
+        with self.condition:
+            self.message_id += 1
+            message_id = self.message_id
+
+        return dict(message_id=message_id, date=int(time.time()), chat=dict(id=chat_id, type='private'),
+                    **{'from': user}, **content)
+
+    def send(self, chat_id, username, text):
+        """Injects a text message of `username`, returns when it was handed out."""
+        user = dict(id=chat_id, is_bot=False, first_name=username, username=username)
+        message = self._message(chat_id, user, text=text)
+
+        if text.startswith('/'):
+            message['entities'] = [dict(type='bot_command', offset=0, length=len(text.split()[0]))]
+
+        return self._update(message)
+
+    def send_document(self, chat_id, username, content, file_name='solution.py'):
+        """Injects a document of `username` holding the bytes `content`, returns when it was handed out."""
+        user = dict(id=chat_id, is_bot=False, first_name=username, username=username)
+        unique_id = hashlib.sha256(content).hexdigest()[:16]
+
+        with self.condition:
+            self.files[unique_id] = content
+
+        document = dict(file_id=unique_id, file_unique_id=unique_id, file_name=file_name, file_size=len(content))
+        return self._update(self._message(chat_id, user, document=document))
+
+    def _update(self, message):
+        with self.condition:
+            self.update_id += 1
+            self.updates.append(dict(update_id=self.update_id, message=message))
+            self.condition.notify_all()
+
+        return time.perf_counter()
+
+    def set_webhook(self, params):
+        with self.condition:
+            start = self.webhook is None
+            self.webhook = params['url'], params.get('secret_token')
+            self.condition.notify_all()
+
+        if start:
+            threading.Thread(target=self._push, name='fakegram-webhook', daemon=True).start()
+
+        self.ready.set()
+        return True
+
+    def delete_webhook(self, params):
+        with self.condition:
+            self.webhook = None
+            self.condition.notify_all()
+
+        return True
+
+    def _push(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.updates or self.webhook is None)
+
+                if self.webhook is None:
+                    return
+
+                (url, secret), batch = self.webhook, self.updates[:self.batch_size]
+
+            request = urllib.request.Request(url, data=json.dumps(batch).encode('utf-8'), headers={
+                'Content-Type': 'application/json', 'X-Telegram-Bot-Api-Secret-Token': secret or '',
+            })
+
+            try:
+                urllib.request.urlopen(request).close()
+
+            except urllib.error.HTTPError as error:
+                # refused, e.g. because the bot is busy, try again later
+                time.sleep(float(error.headers.get('Retry-After') or 1))
+                continue
+
+            except urllib.error.URLError:
+                time.sleep(.1)
+                continue
+
+            with self.condition:
+                del self.updates[:len(batch)]
+
+    def get_updates(self, params):
+        self.ready.set()
+        offset = int(params.get('offset') or 0)
+        limit = int(params.get('limit') or 100)
+
+        with self.condition:
+            self.updates = [u for u in self.updates if u['update_id'] >= offset]
+            self.condition.wait_for(lambda: self.updates, float(params.get('timeout') or 0))
+            return self.updates[:limit]
+
+    def get_file(self, params):
+        with self.condition:
+            content = self.files[params['file_id']]
+
+        return dict(file_id=params['file_id'], file_unique_id=params['file_id'], file_size=len(content),
+                    file_path=f'documents/{params["file_id"]}')
+
+    def download(self, file_id):
+        with self.condition:
+            self.downloads += 1
+            return self.files.get(file_id)
+
+    def reply(self, params):
+        chat_id = int(params['chat_id'])
+        content = dict(text=params.get('text', ''))
+
+        for kind in ('voice', 'document'):
+            if kind in params:
+                content = {kind: dict(file_id=f'{kind}-{self.message_id}', file_unique_id=f'{kind}-{self.message_id}')}
+
+        if 'voice' in content:
+            content['voice']['duration'] = 1
+
+        self.replies[chat_id].put((time.perf_counter(), params))
+        return self._message(chat_id, BOT, **content)
@@ -0,0 +1,142 @@
+# Standard library modules.
+import os
+import sys
+import json
+import queue
+import atexit
+import random
+import logging
+import logging.handlers
+
+# Third party modules.
+
+# Local modules
+
+# Globals and constants variables.
+_FSTRING_LOG = '{asctime}  {threadName:<25}  {levelname:>8}:  {message}'
+
+# everything else a record carries was passed via `extra`
+_RESERVED = {*logging.makeLogRecord({}).__dict__, 'message', 'asctime'}
+
+_LISTENER = None
+
+
+class JSONFormatter(logging.Formatter):
+    """Formats records as one json object per line, fields passed via `extra` are kept as they are."""
+
+    def format(self, record):
+        entry = dict(
+            time=record.created,
+            level=record.levelname,
+            logger=record.name,
+            thread=record.threadName,
+            message=record.getMessage(),
+        )
+
+        entry.update((k, v) for k, v in record.__dict__.items() if k not in _RESERVED)
+
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+
+        return json.dumps(entry, default=repr, ensure_ascii=False)
+
+
+class SampleFilter(logging.Filter):
+    """Passes only a `rate` fraction of the records below `level`, all others pass."""
+
+    def __init__(self, rate=1., level=logging.WARNING):
+        super().__init__()
+        self.rate = rate
+        self.level = level
+
+    def filter(self, record):
+        return record.levelno >= self.level or self.rate >= 1. or random.random() < self.rate
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    """
+    Hands records to a bounded queue without ever blocking. Formatting, including tracebacks,
+    is left to the writer thread. Records that don't fit into the queue are counted and dropped.
+    """
+
+    def __init__(self, queue_):
+        super().__init__(queue_)
+        self.dropped = 0
+
+    def prepare(self, record):
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg, record.args = record.getMessage(), None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+
+        except queue.Full:
+            self.dropped += 1
+
+
+class _Route(logging.Filter):
+    # the writer thread sees the records of all loggers, each handler only takes its own
+    def __init__(self, *names):
+        super().__init__()
+        self.names = names
+
+    def filter(self, record):
+        return record.name in self.names
+
+
+def setup(path, queue_size=10000):
+    """
+    Routes `das-system-log` and `das-system-msg` through a queue to a single writer thread, which
+    prints to stdout and appends json lines to `path/log` (both loggers) and `path/msg`.
+    """
+    global _LISTENER
+
+    os.makedirs(path, exist_ok=True)
+
+    stdout = logging.StreamHandler(stream=sys.stdout)
+    stdout.setFormatter(logging.Formatter(_FSTRING_LOG, style='{'))
+
+    log = logging.FileHandler(f'{path}/log', encoding='utf-8')
+    log.setFormatter(JSONFormatter())
+
+    msg = logging.FileHandler(f'{path}/msg', encoding='utf-8')
+    msg.setFormatter(JSONFormatter())
+    msg.addFilter(_Route('das-system-msg'))
+
+    handler = QueueHandler(queue.Queue(queue_size))
+
+    for name in ('das-system-log', 'das-system-msg'):
+        logger = logging.getLogger(name)
+        logger.addHandler(handler)
+        logger.setLevel(logging.DEBUG)
+        logger.propagate = False
+
+    _LISTENER = logging.handlers.QueueListener(handler.queue, stdout, log, msg, respect_handler_level=True)
+    _LISTENER.start()
+
+    atexit.register(shutdown)
+
+    return handler
+
+
+def sample(rate):
+    """Keeps only a `rate` fraction of the informational message records."""
+    logger = logging.getLogger('das-system-msg')
+
+    for f in logger.filters:
+        if isinstance(f, SampleFilter):
+            f.rate = rate
+            return
+
+    logger.addFilter(SampleFilter(rate))
+
+
+def shutdown():
+    global _LISTENER
+
+    # writes everything still queued
+    if _LISTENER is not None:
+        _LISTENER.stop()
+        _LISTENER = None
@@ -0,0 +1,196 @@
+# Standard library modules.
+import io
+import os
+import json
+import codecs
+import logging
+import hashlib
+import threading
+import urllib.parse
+import urllib.request
+
+# Third party modules.
+from telegram.error import BadRequest
+from telegram.utils.helpers import is_local_file
+
+# Local modules
+from util import tts_renderer
+from cache import LRUCache
+from metrics import stats
+from delivery import BACKGROUND, outbox
+from persistence import atomic_dump
+
+# Globals and constants variables.
+system_log = logging.getLogger('das-system-log')
+
+
+class MediaRegistry:
+    """
+    Maps the sha256 of uploaded payloads to the `file_id` telegram assigned to them, so the same
+    content is sent by reference instead of being uploaded again.
+    """
+
+    def __init__(self):
+        self.path = None
+        self.ids = {}
+        self.dirty = False
+        self.lock = threading.Lock()
+
+    def load(self, path):
+        self.path = os.path.join(path, 'media.json')
+
+        try:
+            with open(self.path, mode='rt', encoding='utf-8') as f:
+                ids = json.load(f)
+
+        except FileNotFoundError:
+            ids = {}
+
+        with self.lock:
+            self.ids.update(ids)
+
+    def persist(self):
+        with self.lock:
+            if not self.dirty or self.path is None:
+                return
+
+            ids, self.dirty = dict(self.ids), False
+
+        atomic_dump(ids, self.path, indent=4)
+
+    def send(self, method, kind, f, **kwargs):
+        """
+        Sends the content of `f` via the bound bot `method` (e.g. `bot.send_voice`) as keyword
+        argument `kind`. A known `file_id` is tried first, if telegram rejects it the content is
+        uploaded and the new id remembered.
+        """
+        data = f.read()
+        key = hashlib.sha256(data).hexdigest()
+
+        with self.lock:
+            file_id = self.ids.get(key)
+
+        if file_id is not None:
+            try:
+                return method(**{kind: file_id}, **kwargs)
+
+            except BadRequest:
+                with self.lock:
+                    self.ids.pop(key, None)
+                    self.dirty = True
+
+        message = method(**{kind: io.BytesIO(data)}, **kwargs)
+
+        # telegram may store the upload with a different type than requested
+        attachment = message.effective_attachment
+        if attachment is not None and hasattr(attachment, 'file_id'):
+            with self.lock:
+                self.ids[key] = attachment.file_id
+                self.dirty = True
+
+        return message
+
+    def send_voice(self, bot, chat_id, f, **kwargs):
+        return self.send(bot.send_voice, 'voice', f, chat_id=chat_id, **kwargs)
+
+    def send_document(self, bot, chat_id, f, **kwargs):
+        return self.send(bot.send_document, 'document', f, chat_id=chat_id, **kwargs)
+
+
+registry = MediaRegistry()
+
+
+class DocumentTooLarge(ValueError):
+    pass
+
+
+class Documents:
+    """
+    Downloads text documents sent to the bot. The size telegram advertises is checked before
+    anything is fetched, the content is streamed and decoded chunk by chunk and refused as soon as
+    it exceeds `max_bytes`. Texts are cached by `file_unique_id`, so a document sent again isn't
+    fetched again.
+    """
+
+    def __init__(self, max_bytes=64 * 1024, maxsize=128, chunk_size=16 * 1024):
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        self.cache = LRUCache(maxsize)
+
+    def configure(self, max_bytes=None, maxsize=None):
+        self.max_bytes = max_bytes or self.max_bytes
+
+        if maxsize:
+            self.cache = LRUCache(maxsize)
+
+    def _check(self, size):
+        if size and size > self.max_bytes:
+            stats.inc('das_documents_total', result='refused')
+            raise DocumentTooLarge(f'document has {size} bytes, at most {self.max_bytes} are allowed')
+
+    def text(self, document):
+        """Returns the content of `document` decoded as utf-8, blocks while it is downloaded."""
+        txt = self.cache.get(document.file_unique_id)
+
+        if txt is not None:
+            stats.inc('das_documents_total', result='cached')
+            return txt
+
+        self._check(document.file_size)
+
+        file = document.get_file()
+        self._check(file.file_size)
+
+        if is_local_file(file.file_path):
+            stream = open(file.file_path, mode='rb')
+
+        else:
+            # the file path may contain characters that aren't allowed in urls
+            url = urllib.parse.urlsplit(file.file_path)
+            stream = urllib.request.urlopen(url._replace(path=urllib.parse.quote(url.path)).geturl(), timeout=30)
+
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        parts, size = [], 0
+
+        with stream:
+            self._check(int(getattr(stream, 'headers', {}).get('Content-Length') or 0))
+
+            for chunk in iter(lambda: stream.read(self.chunk_size), b''):
+                size += len(chunk)
+                self._check(size)
+                parts.append(decoder.decode(chunk))
+
+        parts.append(decoder.decode(b'', final=True))
+        txt = ''.join(parts)
+
+        stats.inc('das_documents_total', result='fetched')
+        self.cache.put(document.file_unique_id, txt)
+
+        return txt
+
+
+documents = Documents()
+
+
+def speak(bot, chat_id, txt):
+    """Queues `txt` as voice message to `chat_id` once it is rendered, without blocking."""
+    def _failed(error):
+        system_log.warning(f'could not send voice message to {chat_id}: {error!r}')
+        outbox.send_message(bot, chat_id, 'Ich bin gerade etwas heiser, versuch es später nochmal.')
+
+    def send_voice(path):
+        with open(path, mode='rb') as f:
+            return registry.send_voice(bot, chat_id, f)
+
+    def _sent(future):
+        if future.exception() is not None:
+            _failed(future.exception())
+
+    def _rendered(future):
+        if future.exception() is not None:
+            return _failed(future.exception())
+
+        # uploads are slow, interactive replies of other chats go first
+        outbox.call(chat_id, send_voice, future.result(), priority=BACKGROUND).add_done_callback(_sent)
+
+    tts_renderer.submit(txt).add_done_callback(_rendered)
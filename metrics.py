@@ -0,0 +1,162 @@
+# Standard library modules.
+import os
+import time
+import bisect
+import tempfile
+import threading
+from contextlib import contextmanager
+
+# Third party modules.
+
+# Local modules
+
+# Globals and constants variables.
+BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10., 30., 60., float('inf'))
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the `q` quantile."""
+        rank, seen = q * self.count, 0
+
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+
+        return self.buckets[-1]
+
+    def copy(self):
+        other = Histogram(self.buckets)
+        other.counts, other.sum, other.count = list(self.counts), self.sum, self.count
+        return other
+
+
+class Metrics:
+    """
+    Counters, latency histograms and gauges, each identified by name and labels. Gauges are
+    callables evaluated on collection. Everything can be rendered in the prometheus text format.
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+
+        with self.lock:
+            histogram = self.histograms.get(key)
+
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+
+        try:
+            yield
+
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def gauge(self, name, func, kind='gauge', **labels):
+        """Registers `func` returning the current value, `kind` may be `counter` for totals kept
+        elsewhere."""
+        with self.lock:
+            self.gauges[self._key(name, labels)] = func, kind
+
+    def collect(self):
+        """Returns a consistent copy of the counters and histograms and the current gauge values."""
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {k: h.copy() for k, h in self.histograms.items()}
+            gauges = dict(self.gauges)
+
+        values = {}
+        for key, (func, kind) in gauges.items():
+            try:
+                values[key] = func(), kind
+
+            except Exception:
+                # e.g. a component that is already shut down
+                continue
+
+        return counters, histograms, values
+
+    def render(self):
+        counters, histograms, gauges = self.collect()
+        lines, types = [], {}
+
+        def _labels(labels, **extra):
+            labels = [*labels, *extra.items()]
+            return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}' if labels else ''
+
+        def _type(name, kind):
+            if name not in types:
+                types[name] = kind
+                lines.append(f'# TYPE {name} {kind}')
+
+        for (name, labels), value in sorted(counters.items()):
+            _type(name, 'counter')
+            lines.append(f'{name}{_labels(labels)} {value}')
+
+        for (name, labels), (value, kind) in sorted(gauges.items()):
+            _type(name, kind)
+            lines.append(f'{name}{_labels(labels)} {value}')
+
+        for (name, labels), histogram in sorted(histograms.items()):
+            _type(name, 'histogram')
+            cumulative = 0
+
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'{name}_bucket{_labels(labels, le=le)} {cumulative}')
+
+            lines.append(f'{name}_sum{_labels(labels)} {histogram.sum}')
+            lines.append(f'{name}_count{_labels(labels)} {histogram.count}')
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        fd, tmp = tempfile.mkstemp(prefix='.', suffix='.tmp', dir=os.path.dirname(path) or '.')
+
+        try:
+            with os.fdopen(fd, mode='wt', encoding='utf-8') as f:
+                f.write(self.render())
+
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+        os.replace(tmp, path)
+
+
+stats = Metrics()
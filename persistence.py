@@ -0,0 +1,285 @@
+# Standard library modules.
+import os
+import abc
+import copy
+import json
+import sqlite3
+import tempfile
+import threading
+
+# Third party modules.
+from mosquito.utils import NameSpaceDict
+
+# Local modules
+from util import KeyedLock
+from cache import LRUCache
+
+# Globals and constants variables.
+
+
+def atomic_dump(obj, path, **kwargs):
+    """Serialize `obj` as json to `path` without ever exposing a partially written file."""
+    fd, tmp = tempfile.mkstemp(prefix='.', suffix='.tmp', dir=os.path.dirname(path) or '.')
+
+    try:
+        with os.fdopen(fd, mode='wt', encoding='utf-8') as f:
+            json.dump(obj, f, **kwargs)
+            f.flush()
+            os.fsync(f.fileno())
+
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+    os.replace(tmp, path)
+
+
+def read_journaled(snapshot_path, journal_path):
+    """Returns the state stored as snapshot + journal, the number of replayed entries and
+    whether the journal ended with a torn write."""
+    try:
+        with open(snapshot_path, mode='rt', encoding='utf-8') as f:
+            state = json.load(f)
+
+    except FileNotFoundError:
+        state = {}
+
+    entries, torn = 0, False
+    try:
+        with open(journal_path, mode='rt', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+
+                except json.JSONDecodeError:
+                    # the last write was interrupted, everything before is intact
+                    torn = True
+                    break
+
+                if entry['state'] is None:
+                    state.pop(entry['user'], None)
+                else:
+                    state[entry['user']] = entry['state']
+
+                entries += 1
+
+    except FileNotFoundError:
+        pass
+
+    return state, entries, torn
+
+
+class StateStore(abc.ABC):
+    @abc.abstractmethod
+    def load(self, user):
+        """Returns the record of `user` or `None` if it is unknown."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def commit(self, changes):
+        """Atomically stores `changes` ({user: record or None}), `None` deletes a user."""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class JournalStore(StateStore):
+    """
+    Keeps the user states as a snapshot (`state.json`) plus an append-only journal
+    (`state.journal`) holding one json line per changed user. Once the journal contains
+    `compact_after` entries it is folded into a fresh snapshot.
+    """
+
+    def __init__(self, path, compact_after=1000):
+        self.snapshot_path = os.path.join(path, 'state.json')
+        self.journal_path = os.path.join(path, 'state.journal')
+        self.compact_after = compact_after
+
+        self.state, self.entries, torn = read_journaled(self.snapshot_path, self.journal_path)
+        self.journal = open(self.journal_path, mode='at', encoding='utf-8')
+
+        # never append behind a broken line
+        if torn:
+            self.compact()
+
+    def load(self, user):
+        return copy.deepcopy(self.state.get(user))
+
+    def commit(self, changes):
+        if not changes:
+            return
+
+        lines = [json.dumps(dict(user=user, state=record)) + '\n' for user, record in changes.items()]
+        self.journal.writelines(lines)
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+
+        for user, record in changes.items():
+            if record is None:
+                self.state.pop(user, None)
+            else:
+                self.state[user] = copy.deepcopy(record)
+
+        self.entries += len(changes)
+
+        if self.entries >= self.compact_after:
+            self.compact()
+
+    def compact(self):
+        # a crash between both steps is harmless as replaying the journal is idempotent
+        atomic_dump(self.state, self.snapshot_path, indent=4)
+
+        self.journal.close()
+        self.journal = open(self.journal_path, mode='wt', encoding='utf-8')
+        self.entries = 0
+
+    def close(self):
+        if self.entries:
+            self.compact()
+
+        self.journal.close()
+
+
+class SQLiteStore(StateStore):
+    """Stores one json encoded record per user in an embedded sqlite database (`state.sqlite`)."""
+
+    def __init__(self, path):
+        self.path = os.path.join(path, 'state.sqlite')
+        self.lock = threading.Lock()
+
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS state (user TEXT PRIMARY KEY, record TEXT NOT NULL)')
+        self.db.commit()
+
+    def load(self, user):
+        with self.lock:
+            row = self.db.execute('SELECT record FROM state WHERE user = ?', (user,)).fetchone()
+
+        return json.loads(row[0]) if row else None
+
+    def commit(self, changes):
+        upserts = [(u, json.dumps(r)) for u, r in changes.items() if r is not None]
+        deletes = [(u,) for u, r in changes.items() if r is None]
+
+        with self.lock, self.db:
+            self.db.executemany('INSERT OR REPLACE INTO state (user, record) VALUES (?, ?)', upserts)
+            self.db.executemany('DELETE FROM state WHERE user = ?', deletes)
+
+    def migrate(self, path):
+        """
+        Imports the users of a json state (`state.json` and `state.journal`) located at `path`.
+        Users already present in the database are kept. The imported files are renamed to
+        `*.migrated` afterwards, so the import happens exactly once.
+        """
+        sources = [os.path.join(path, f) for f in ('state.json', 'state.journal')]
+
+        if not any(map(os.path.exists, sources)):
+            return 0
+
+        state, _, _ = read_journaled(*sources)
+
+        with self.lock, self.db:
+            self.db.executemany(
+                'INSERT OR IGNORE INTO state (user, record) VALUES (?, ?)',
+                [(u, json.dumps(r)) for u, r in state.items()]
+            )
+
+        for source in filter(os.path.exists, sources):
+            os.replace(source, source + '.migrated')
+
+        return len(state)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+BACKENDS = dict(journal=JournalStore, sqlite=SQLiteStore)
+
+
+class UserStates:
+    """
+    Lazily loads user records from a :class:`StateStore` into a bounded LRU cache. Access to
+    the record of a user has to be guarded by `locks[user]` (a :class:`util.KeyedLock`).
+    Modified records have to be reported via :meth:`mark_dirty`, which takes a snapshot of them.
+    Snapshots are written by :meth:`flush` or as soon as the record is evicted from the cache.
+    """
+
+    def __init__(self, store, maxsize=1024, factory=dict, locks=None):
+        self.store = store
+        self.factory = factory
+        self.locks = KeyedLock() if locks is None else locks
+        self.dirty = {}
+        self.lock = threading.Lock()
+        self.commit_lock = threading.Lock()
+        self.cache = LRUCache(maxsize, on_evict=self._write_back)
+
+    def _write_back(self, user, record):
+        # commits are serialized, so an older snapshot never overwrites a newer one
+        with self.commit_lock:
+            with self.lock:
+                snapshot = self.dirty.pop(user, None)
+
+            if snapshot is not None:
+                self.store.commit({user: snapshot})
+
+    def get(self, user):
+        record = self.cache.get(user)
+
+        if record is None:
+            # a snapshot of an evicted record might not have reached the store yet
+            with self.commit_lock:
+                with self.lock:
+                    snapshot = self.dirty.get(user)
+
+                loaded = self.store.load(user) if snapshot is None else copy.deepcopy(snapshot)
+
+            record = NameSpaceDict(self.factory() if loaded is None else loaded)
+            self.cache.put(user, record)
+
+            if loaded is None:
+                self.mark_dirty(user, record)
+
+        return record
+
+    def mark_dirty(self, user, record):
+        snapshot = copy.deepcopy(record)
+
+        with self.lock:
+            self.dirty[user] = snapshot
+
+        # the record might have been evicted while it was in use
+        if self.cache.peek(user) is not record:
+            self.cache.put(user, record)
+
+    def flush(self):
+        with self.commit_lock:
+            with self.lock:
+                changes, self.dirty = self.dirty, {}
+
+            if not changes:
+                return
+
+            try:
+                self.store.commit(changes)
+
+            except BaseException:
+                with self.lock:
+                    self.dirty = {**changes, **self.dirty}
+
+                raise
+
+    def release(self, moved):
+        """Writes all changes and drops the cached records of the users `moved(user)` is true for,
+        e.g. because another process owns them from now on. Nobody may use them meanwhile."""
+        self.flush()
+
+        for user in filter(moved, self.cache.keys()):
+            self.cache.pop(user)
+
+    def close(self):
+        self.flush()
+        self.store.close()
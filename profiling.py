@@ -0,0 +1,153 @@
+# Standard library modules.
+import os
+import time
+import random
+import pstats
+import cProfile
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+# Third party modules.
+
+# Local modules
+from dispatch import offload
+
+# Globals and constants variables.
+_IGNORE = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, '<frozen importlib._bootstrap>')]
+
+
+class Recording:
+    """The profile and memory snapshots taken by :func:`capture`."""
+
+    def __init__(self):
+        self.profile = cProfile.Profile()
+        self.before = self.after = None
+        self.peak = None
+
+    def write(self, path, name, top):
+        """
+        Dumps the raw profile to `path/<name>-*.prof`, a report of the `top` functions by
+        cumulative time and the `top` allocations still alive afterwards to `path/<name>-*.txt`.
+        """
+        os.makedirs(path, exist_ok=True)
+        base = os.path.join(path, f'{name}-{time.strftime("%Y%m%d-%H%M%S")}-{time.time_ns() % 10 ** 9:09d}')
+
+        self.profile.dump_stats(base + '.prof')
+
+        with open(base + '.txt', mode='wt', encoding='utf-8') as f:
+            pstats.Stats(self.profile, stream=f).sort_stats('cumulative').print_stats(top)
+
+            # tracemalloc sees every thread, allocations of concurrent work show up as well
+            if self.peak is not None:
+                f.write(f'peak traced memory: {self.peak / 1024:.1f}KiB\n')
+
+            f.write(f'top {top} allocations:\n')
+
+            for stat in self.after.filter_traces(_IGNORE).compare_to(self.before.filter_traces(_IGNORE), 'lineno')[:top]:
+                f.write(f'  {stat}\n')
+
+
+@contextmanager
+def capture():
+    """Runs the body under cProfile and tracemalloc, yields the :class:`Recording`."""
+    recorded = Recording()
+
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+
+    # before python 3.9 the peak can't be reset, it only belongs to the body if tracing starts here
+    peak = not tracing or hasattr(tracemalloc, 'reset_peak')
+    if tracing and peak:
+        tracemalloc.reset_peak()
+
+    recorded.before = tracemalloc.take_snapshot()
+    recorded.profile.enable()
+
+    try:
+        yield recorded
+
+    finally:
+        recorded.profile.disable()
+        recorded.after = tracemalloc.take_snapshot()
+
+        if peak:
+            _, recorded.peak = tracemalloc.get_traced_memory()
+
+        if not tracing:
+            tracemalloc.stop()
+
+
+@contextmanager
+def recording(path, name, top):
+    """Runs the body under :func:`capture` and writes the results to `path`, see
+    :meth:`Recording.write`."""
+    recorded = None
+
+    try:
+        with capture() as recorded:
+            yield
+
+    finally:
+        if recorded is not None:
+            recorded.write(path, name, top)
+
+
+def record(path, name, top, func, *args, **kwargs):
+    """Calls `func` while :func:`recording`."""
+    with recording(path, name, top):
+        return func(*args, **kwargs)
+
+
+class Profiler:
+    """
+    Profiles a `rate` fraction of the coroutines awaited through :meth:`call`, disabled by default.
+    Only one call is profiled at a time. The profile covers everything its thread runs meanwhile,
+    i.e. other coroutines of the same event loop as well.
+    """
+
+    def __init__(self, path='~/.das_system/profiles', top=25):
+        self.path = os.path.expanduser(path)
+        self.top = top
+        self.rate = 0.
+        self.lock = threading.Lock()
+
+    def configure(self, path=None, top=None, rate=None):
+        if path is not None:
+            self.path = os.path.expanduser(path)
+
+        if top is not None:
+            self.top = top
+
+        if rate is not None:
+            self.rate = rate
+
+    def sample(self):
+        return self.rate > 0. and random.random() < self.rate
+
+    async def call(self, name, func, *args, **kwargs):
+        # costs a single comparison while disabled
+        if not self.sample() or not self.lock.acquire(blocking=False):
+            return await func(*args, **kwargs)
+
+        recorded = None
+
+        try:
+            with capture() as recorded:
+                return await func(*args, **kwargs)
+
+        finally:
+            self.lock.release()
+
+            # diffing the snapshots and writing the report would stall every conversation
+            if recorded is not None:
+                await offload(recorded.write, self.path, name, self.top)
+
+    def target(self):
+        """Where a sampled execution in a worker process should write its profile, `None` if
+        it is not sampled."""
+        return (self.path, self.top) if self.sample() else None
+
+
+profiler = Profiler()
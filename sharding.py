@@ -0,0 +1,308 @@
+# Standard library modules.
+import os
+import json
+import time
+import socket
+import hashlib
+import logging
+import threading
+from collections import deque
+
+# Third party modules.
+import telegram
+
+# Local modules
+from metrics import stats
+
+# Globals and constants variables.
+system_log = logging.getLogger('das-system-log')
+
+
+def owner(key, members):
+    """The member responsible for `key`, every process comes to the same result. Adding or removing
+    a member only moves the keys it gains or loses (rendezvous hashing)."""
+    if not members:
+        return None
+
+    return max(members, key=lambda m: hashlib.blake2b(f'{m}/{key}'.encode('utf-8'), digest_size=8).digest())
+
+
+def route_key(update):
+    # users are identified by their username everywhere else, e.g. in the state store
+    if update.effective_user is not None and update.effective_user.username:
+        return update.effective_user.username
+
+    return str(update.effective_chat.id if update.effective_chat is not None else update.update_id)
+
+
+def _send(f, lock, **message):
+    with lock:
+        f.write(json.dumps(message).encode('utf-8') + b'\n')
+        f.flush()
+
+
+class _Member:
+    def __init__(self, name, conn):
+        self.name = name
+        self.conn = conn
+        self.file = conn.makefile('rwb')
+        self.lock = threading.Lock()
+        self.released = threading.Event()
+
+    def send(self, **message):
+        _send(self.file, self.lock, **message)
+
+
+class Ingress:
+    """
+    Routes updates by user to the worker processes connected to the unix socket at `path`. Before
+    the users are assigned anew because a worker joined or left, all workers finish the updates
+    they got, write the states of their users and drop those they lose. Meanwhile, and while no
+    worker is connected at all, updates are held back.
+    """
+
+    def __init__(self, path, timeout_=60):
+        self.path = path
+        self.timeout = timeout_
+        self.members = {}
+        self.held = deque()
+        self.rebalancing = False
+        self.lock = threading.Lock()
+        self.membership = threading.Lock()
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    def start(self):
+        # a socket left behind by a previous run
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+        self.server.bind(self.path)
+        self.server.listen()
+
+        threading.Thread(target=self._accept, name='ingress', daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.close()
+
+        with self.lock:
+            members = list(self.members.values())
+
+        for member in members:
+            member.conn.close()
+
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def size(self):
+        with self.lock:
+            return len(self.members)
+
+    def depth(self):
+        with self.lock:
+            return len(self.held)
+
+    def route(self, update):
+        with self.lock:
+            self._route(update)
+
+    def _route(self, update):
+        if self.rebalancing:
+            self.held.append(update)
+            return
+
+        name = owner(route_key(update), sorted(self.members))
+
+        try:
+            if name is None:
+                raise ConnectionError('no worker connected')
+
+            self.members[name].send(type='update', update=update.to_dict())
+
+        except OSError:
+            # kept until the workers changed, a lost worker is about to leave
+            self.held.append(update)
+            stats.inc('das_ingress_updates_total', result='held')
+
+        else:
+            stats.inc('das_ingress_updates_total', worker=name, result='routed')
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self.server.accept()
+
+            except OSError:
+                return
+
+            threading.Thread(target=self._serve, args=(conn,), name='ingress-member', daemon=True).start()
+
+    def _serve(self, conn):
+        member = None
+
+        try:
+            f = conn.makefile('rb')
+            hello = json.loads(f.readline() or 'null')
+
+            if not hello or hello.get('type') != 'hello':
+                return conn.close()
+
+            member = _Member(hello['name'], conn)
+            if not self._rebalance(join=member):
+                return conn.close()
+
+            for line in f:
+                message = json.loads(line)
+
+                if message['type'] == 'released':
+                    member.released.set()
+
+                elif message['type'] == 'leave':
+                    # the acknowledgement of the leaving worker is read by this thread
+                    threading.Thread(target=self._rebalance, kwargs=dict(leave=member), daemon=True).start()
+
+        except (OSError, ValueError) as error:
+            system_log.warning(f'lost worker {member.name if member else "?"}: {error!r}')
+
+        finally:
+            if member is not None:
+                # nobody must wait for it anymore
+                member.released.set()
+                self._rebalance(leave=member)
+
+    def _rebalance(self, join=None, leave=None):
+        with self.membership:
+            members = dict(self.members)
+
+            if join is not None:
+                if join.name in members:
+                    system_log.warning(f'refused worker {join.name}, the name is taken')
+                    return False
+
+                members[join.name] = join
+
+            if leave is not None:
+                if members.get(leave.name) is not leave:
+                    return False
+
+                del members[leave.name]
+
+            with self.lock:
+                self.rebalancing = True
+
+            # everybody except the new worker may lose users, the leaving one all of them
+            releasing = [m for m in (*members.values(), leave) if m is not None and m is not join]
+
+            for member in releasing:
+                member.released.clear()
+
+                try:
+                    member.send(type='release', members=sorted(members))
+
+                except OSError:
+                    member.released.set()
+
+            start = time.monotonic()
+            for member in releasing:
+                if not member.released.wait(max(0., self.timeout - (time.monotonic() - start))):
+                    system_log.warning(f'worker {member.name} did not release its users in time')
+
+            with self.lock:
+                self.members = members
+                self.rebalancing = False
+
+                held, self.held = self.held, deque()
+                for update in held:
+                    self._route(update)
+
+            system_log.info(f'workers: {sorted(members)}')
+            return True
+
+
+class ShardClient:
+    """
+    Connects the worker `name` to the ingress at `path`. Routed updates are passed to
+    `handle(update)`. Once the users are assigned anew, `release(members)` is called and has to
+    return only after the users the worker loses are written and dropped. After losing the
+    ingress, the worker releases all of its users and connects again.
+    """
+
+    def __init__(self, path, name, bot, handle, release):
+        self.path = path
+        self.name = name
+        self.bot = bot
+        self.handle = handle
+        self.release = release
+        self.conn = None
+        self.lock = threading.Lock()
+        self.left = threading.Event()
+        self.closed = False
+
+    def start(self):
+        threading.Thread(target=self._run, name='shard', daemon=True).start()
+        return self
+
+    def leave(self, timeout_=60):
+        """Hands the users over to the other workers, returns once they were released."""
+        self.closed = True
+
+        try:
+            _send(self.conn.makefile('wb'), self.lock, type='leave')
+
+        except (OSError, AttributeError):
+            return
+
+        self.left.wait(timeout_)
+
+    def stop(self):
+        self.closed = True
+
+        if self.conn is not None:
+            self.conn.close()
+
+    def _run(self):
+        while not self.closed:
+            connected = False
+
+            try:
+                self.conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self.conn.connect(self.path)
+                connected = True
+                self._serve()
+
+            except (OSError, ValueError) as error:
+                if connected and not self.closed:
+                    system_log.warning(f'lost the ingress: {error!r}')
+
+            self.conn.close()
+
+            # nobody is going to take the users anymore
+            if self.closed:
+                self.left.set()
+                return
+
+            # they might move on meanwhile, e.g. while the ingress restarts
+            if connected:
+                self.release([])
+
+            time.sleep(1)
+
+    def _serve(self):
+        f = self.conn.makefile('rwb')
+        _send(f, self.lock, type='hello', name=self.name)
+
+        for line in f:
+            message = json.loads(line)
+
+            if message['type'] == 'update':
+                self.handle(telegram.Update.de_json(message['update'], self.bot))
+
+            elif message['type'] == 'release':
+                self.release(message['members'])
+                _send(f, self.lock, type='released')
+
+                if self.name not in message['members']:
+                    self.left.set()
+
+        if not self.closed:
+            raise ConnectionError('the ingress closed the connection')
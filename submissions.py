@@ -0,0 +1,165 @@
+# Standard library modules.
+import asyncio
+from functools import wraps
+from collections import OrderedDict, deque
+
+# Third party modules.
+
+# Local modules
+import executor
+from cache import LRUCache
+from metrics import stats
+
+# Globals and constants variables.
+
+
+class SubmissionError(Exception):
+    pass
+
+
+class Busy(SubmissionError):
+    def __init__(self):
+        super().__init__('Ich bin gerade ausgelastet, versuch es gleich nochmal.')
+
+
+class Superseded(SubmissionError):
+    def __init__(self):
+        super().__init__('Übersprungen, du hast inzwischen eine neuere Lösung geschickt.')
+
+
+class SubmissionScheduler:
+    """
+    Queues the executions of submissions per user and hands them to the worker pool in round robin
+    order across users, at most `slots` at a time. Submissions are ordered by the id of their
+    update. Once a newer submission of a user arrived, the older ones still waiting are dropped
+    with :class:`Superseded`, executions already running are finished. While `max_pending`
+    executions wait, further ones are refused with :class:`Busy`, so are those still waiting
+    after `max_wait` seconds.
+
+    Lives on the event loop of the handlers and must only be used from there.
+    """
+
+    def __init__(self, slots=1, max_pending=6, max_wait=60):
+        self.slots = slots
+        self.max_pending = max_pending
+        self.max_wait = max_wait
+        self.latest = LRUCache(65536)
+        self.queues = OrderedDict()
+        self.pending = 0
+        self.running = 0
+
+    def configure(self, slots=None, max_pending=None, max_wait=None):
+        self.slots = slots or self.slots
+        self.max_pending = max_pending or self.max_pending
+        self.max_wait = max_wait or self.max_wait
+
+    def depth(self):
+        return self.pending
+
+    def admit(self, func):
+        """Decorates a handler whose updates are submissions, so a newer submission is known
+        before the older ones waiting for the lock of the user get their turn."""
+        @wraps(func)
+        async def wrapper(update, context):
+            self.arrive(update.effective_user.username, update.update_id)
+            return await func(update, context)
+
+        return wrapper
+
+    def arrive(self, user, ticket):
+        latest = self.latest.get(user)
+
+        if latest is not None and ticket <= latest:
+            return
+
+        self.latest.put(user, ticket)
+
+        jobs = self.queues.pop(user, ())
+        self.pending -= len(jobs)
+
+        for _, future in jobs:
+            if not future.done():
+                stats.inc('das_submissions_total', result='superseded')
+                future.set_exception(Superseded())
+
+    def check(self, update):
+        """Raises :class:`Superseded` if a newer submission of the user arrived."""
+        if update.update_id < self.latest.get(update.effective_user.username, update.update_id):
+            stats.inc('das_submissions_total', result='superseded')
+            raise Superseded()
+
+    async def run(self, update, *args):
+        """Returns the result of :func:`executor.submit` with `args` once the submission of
+        `update` got its turn and was executed."""
+        self.check(update)
+
+        if self.pending >= self.max_pending:
+            stats.inc('das_submissions_total', result='busy')
+            raise Busy()
+
+        loop = asyncio.get_running_loop()
+        user, job = update.effective_user.username, (args, loop.create_future())
+
+        self.queues.setdefault(user, deque()).append(job)
+        self.pending += 1
+
+        expiry = loop.call_later(self.max_wait, self._expire, user, job)
+        self._dispatch()
+
+        try:
+            return await job[1]
+
+        finally:
+            expiry.cancel()
+
+    def _expire(self, user, job):
+        jobs = self.queues.get(user, ())
+
+        # the job got its turn meanwhile or was dropped already
+        if job not in jobs:
+            return
+
+        jobs.remove(job)
+        self.pending -= 1
+
+        if not jobs:
+            del self.queues[user]
+
+        stats.inc('das_submissions_total', result='busy')
+        job[1].set_exception(Busy())
+
+    def _dispatch(self):
+        while self.running < self.slots and self.queues:
+            # the user served goes to the back of the line
+            user, jobs = next(iter(self.queues.items()))
+            args, future = jobs.popleft()
+            self.pending -= 1
+
+            if jobs:
+                self.queues.move_to_end(user)
+            else:
+                del self.queues[user]
+
+            # e.g. the handler timed out while waiting
+            if future.done():
+                continue
+
+            stats.inc('das_submissions_total', result='executed')
+            self.running += 1
+
+            execution = asyncio.wrap_future(executor.submit(*args))
+            execution.add_done_callback(lambda execution, future=future: self._finished(future, execution))
+
+    def _finished(self, future, execution):
+        self.running -= 1
+
+        if not future.done():
+            if execution.exception() is not None:
+                future.set_exception(execution.exception())
+            else:
+                future.set_result(execution.result())
+
+        self._dispatch()
+
+
+submissions = SubmissionScheduler()
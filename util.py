@@ -1,68 +1,573 @@
 # Standard library modules.
 import io
+import os
 import sys
+import json
 import time
+import hashlib
+import queue
+import ctypes
+import signal
+import resource
+import threading
 import traceback
 import subprocess
 from functools import partial
-from contextlib import contextmanager, redirect_stdout, redirect_stderr
+from collections import namedtuple
+from concurrent.futures import Future
+from contextlib import contextmanager
 from tempfile import NamedTemporaryFile
 
 # Third party modules.
 
 # Local modules
+from metrics import stats
 
 # Globals and constants variables.
+MAX_OUTPUT = 64 * 1024
+TTS_VOICE = dict(voice='de', capitals=5, speed=150)
+
+_STREAMS_LOCK = threading.Lock()
+
+# a process forked while another one is being spawned inherits its exec status pipe, `Popen`
+# would then wait for the forked process to exit
+FORK_LOCK = threading.Lock()
+
+# a single check of a test table: `expr` is evaluated in the namespace of the submission and its
+# value compared to `expected` by one of the `COMPARISONS`
+Case = namedtuple('Case', 'expr expected compare', defaults=('eq',))
+
+COMPARISONS = {
+    'eq': lambda value, expected: value == expected,
+    'is': lambda value, expected: value is expected,
+    'str': lambda value, expected: str(value) == expected,
+    'approx': lambda value, expected: abs(value - expected) < 1e-3,
+}
+
+
+class KeyedLock:
+    """
+    One lock made by `factory` per key, so different keys never contend. A lock is dropped once
+    nobody holds or waits for it. `locks[key]` is used with `with` or, for asyncio locks, with
+    `async with`.
+    """
+
+    def __init__(self, factory=threading.RLock):
+        self.factory = factory
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    def __getitem__(self, key):
+        return _KeyedLockEntry(self, key)
+
+    def _take(self, key):
+        with self.lock:
+            # made on first use, before python 3.10 an asyncio lock belongs to the loop current then
+            entry = self.locks.get(key)
+            if entry is None:
+                entry = self.locks[key] = [self.factory(), 0]
+
+            entry[1] += 1
+            return entry[0]
+
+    def _return(self, key):
+        with self.lock:
+            entry = self.locks[key]
+            entry[1] -= 1
+
+            if not entry[1]:
+                del self.locks[key]
+
+
+class _KeyedLockEntry:
+    __slots__ = 'owner', 'key', 'lock'
+
+    def __init__(self, owner, key):
+        self.owner = owner
+        self.key = key
+        self.lock = None
+
+    def __enter__(self):
+        self.lock = self.owner._take(self.key)
+
+        try:
+            self.lock.acquire()
+
+        except BaseException:
+            self.owner._return(self.key)
+            raise
+
+    def __exit__(self, *exc_info):
+        self.lock.release()
+        self.owner._return(self.key)
+
+    async def __aenter__(self):
+        self.lock = self.owner._take(self.key)
+
+        try:
+            await self.lock.acquire()
+
+        except BaseException:
+            # e.g. cancelled while waiting
+            self.owner._return(self.key)
+            raise
+
+    async def __aexit__(self, *exc_info):
+        self.lock.release()
+        self.owner._return(self.key)
+
+
+class ExecutionTimeout(TimeoutError):
+    timeout = None
+
+    def __init__(self, *args):
+        # raised asynchronously, i.e. python instantiates it without arguments
+        super().__init__(*args or (f'code execution took longer than {self.timeout:.3f}s to terminate',))
+
+
+class CPUTimeExceeded(TimeoutError):
+    pass
+
+
+def _async_raise(ident, exc_type):
+    # `None` clears an exception that is still pending
+    ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(ident), ctypes.py_object(exc_type) if exc_type else None)
+
+
+class _Watchdog(threading.Thread):
+    """
+    Raises an :class:`ExecutionTimeout` inside the thread `target` once `timeout_` seconds have
+    passed. The exception is raised again every `interval` seconds until the watchdog is
+    stopped, so code swallowing it can't escape.
+    """
+
+    def __init__(self, target, timeout_, interval=.1):
+        super().__init__(name=f'watchdog-{target}', daemon=True)
+
+        self.target = target
+        self.timeout = timeout_
+        self.interval = interval
+        self.error = type(ExecutionTimeout.__name__, (ExecutionTimeout,), dict(timeout=timeout_))
+        self.done = threading.Event()
+        self.lock = threading.Lock()
+        self.fired = False
+
+    def run(self):
+        delay = self.timeout
+
+        while not self.done.wait(delay):
+            with self.lock:
+                if self.done.is_set():
+                    return
+
+                _async_raise(self.target, self.error)
+                self.fired = True
+
+            delay = self.interval
+
+    def stop(self):
+        # called from the watched thread, which may receive the exception at any bytecode
+        while True:
+            try:
+                with self.lock:
+                    self.done.set()
+
+                    if self.fired:
+                        _async_raise(self.target, None)
+
+                return
+
+            except ExecutionTimeout:
+                continue
 
 
 @contextmanager
 def timeout(timeout_):
     start = time.time()
 
-    # trace callbacks
-    def _globaltrace(frame, event, arg):
-        return _localtrace if event == 'call' else None
-
-    def _localtrace(frame, event, arg):
-        if time.time() - start >= timeout_ and event == 'line':
-            raise TimeoutError(f'code execution took longer than {timeout_:.3f}s to terminate')
+    # start watchdog only in case timeout was actually set
+    if not timeout_:
+        yield start
+        return
 
-    # activate tracing only in case timeout was actually set
-    if timeout_:
-        sys.settrace(_globaltrace)
+    watchdog = _Watchdog(threading.get_ident(), timeout_)
+    watchdog.start()
 
     try:
         yield start
 
     finally:
-        sys.settrace(None)
+        watchdog.stop()
+
+
+class BoundedBuffer(io.TextIOBase):
+    """Text buffer keeping at most `limit` bytes (utf-8) of what is written to it, the rest is
+    dropped and `truncated` gets set."""
+
+    def __init__(self, limit=MAX_OUTPUT):
+        super().__init__()
+
+        self.limit = limit
+        self.size = 0
+        self.truncated = False
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, s):
+        if not isinstance(s, str):
+            raise TypeError(f'write() argument must be str, not {type(s).__name__}')
+
+        remaining = self.limit - self.size
+        data = s[:remaining].encode('utf-8', 'surrogatepass')
+
+        if len(data) > remaining or len(s) > remaining:
+            self.truncated = True
+            data = data[:remaining]
+
+        if data:
+            self.size += len(data)
+            self._chunks.append(data)
+
+        return len(s)
+
+    def getvalue(self):
+        return b''.join(self._chunks).decode('utf-8', 'ignore')
+
+
+class _ThreadLocalStream:
+    """Stand-in for `sys.stdout`/`sys.stderr` which writes to a per thread target, if one is
+    set, and to the original stream otherwise."""
+
+    def __init__(self, fallback):
+        self.fallback = fallback
+        self.local = threading.local()
+
+    @property
+    def target(self):
+        return getattr(self.local, 'stream', None) or self.fallback
+
+    def __getattr__(self, item):
+        return getattr(self.target, item)
+
+    def write(self, s):
+        return self.target.write(s)
+
+    def flush(self):
+        return self.target.flush()
+
+
+def _install_streams():
+    with _STREAMS_LOCK:
+        if not isinstance(sys.stdout, _ThreadLocalStream):
+            sys.stdout = _ThreadLocalStream(sys.stdout)
+
+        if not isinstance(sys.stderr, _ThreadLocalStream):
+            sys.stderr = _ThreadLocalStream(sys.stderr)
+
+    return sys.stdout, sys.stderr
+
+
+@contextmanager
+def capture_output(limit=MAX_OUTPUT):
+    """
+    Redirects `sys.stdout` and `sys.stderr` of the current thread only into bounded buffers.
+    Unlike :func:`contextlib.redirect_stdout` concurrent captures in different threads don't
+    interfere.
+    """
+    streams = _install_streams()
+    buffers = BoundedBuffer(limit), BoundedBuffer(limit)
+    previous = [getattr(s.local, 'stream', None) for s in streams]
+
+    for stream, buffer in zip(streams, buffers):
+        stream.local.stream = buffer
+
+    try:
+        yield buffers
+
+    finally:
+        for stream, prev in zip(streams, previous):
+            stream.local.stream = prev
 
 
-def sandboxed_exec(code, timeout_=None, namespace=None):
-    state = dict(__EXCEPTION__=None)
+def _proc_status(field):
+    # value of a `/proc/self/status` field in bytes, linux only
+    try:
+        with open('/proc/self/status', mode='rt') as f:
+            for line in f:
+                if line.startswith(f'{field}:'):
+                    return int(line.split()[1]) * 1024
+
+    except OSError:
+        pass
+
+    return None
+
+
+def peak_rss():
+    return _proc_status('VmHWM') or resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', mode='wt') as f:
+            f.write('5')
+
+    except OSError:
+        pass
+
+
+@contextmanager
+def resource_limits(cpu=None, memory=None):
+    """
+    Limits the cpu time (seconds) and the additional address space (bytes) of the whole
+    *process* while the context is active, so this must only be used inside of worker processes
+    and from their main thread. Exceeding the cpu time raises :class:`CPUTimeExceeded`, exceeding
+    the address space a `MemoryError`.
+    """
+    if cpu:
+        def _expired(signum, frame):
+            raise CPUTimeExceeded(f'code execution used more than {cpu:.3f}s of cpu time')
+
+        handler = signal.signal(signal.SIGPROF, _expired)
+        # keep firing in case the code swallows the exception
+        signal.setitimer(signal.ITIMER_PROF, cpu, .1)
+
+    if memory:
+        soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+        limit = (_proc_status('VmSize') or 0) + memory
+
+        if hard != resource.RLIM_INFINITY:
+            limit = min(limit, hard)
+
+        resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+
+    try:
+        yield
+
+    finally:
+        if memory:
+            resource.setrlimit(resource.RLIMIT_AS, (soft, hard))
+
+        if cpu:
+            signal.setitimer(signal.ITIMER_PROF, 0)
+            signal.signal(signal.SIGPROF, handler)
+
+
+def run_cases(cases, namespace):
+    results = []
+
+    for case in map(Case._make, cases):
+        start, error = time.perf_counter(), None
+
+        try:
+            passed = bool(COMPARISONS[case.compare](eval(case.expr, namespace), case.expected))
+
+        except Exception as e:
+            passed, error = False, f'{type(e).__name__}: {e}'
+
+        results.append(dict(expr=case.expr, passed=passed, time=time.perf_counter() - start, error=error))
+
+    return results
+
+
+def sandboxed_exec(code, timeout_=None, namespace=None, max_output=MAX_OUTPUT, cases=()):
+    """
+    Executes `code` and evaluates the test table `cases` (see :class:`Case`) against the
+    resulting namespace. The timeout covers both. Returns the namespace with the captured output,
+    the exception, the case results and the resource usage added.
+    """
+    state = dict(__EXCEPTION__=None, __CASES__=[])
 
     if namespace:
         state.update(namespace)
 
-    with io.StringIO() as stdout, io.StringIO() as stderr:
-        with redirect_stdout(stdout), redirect_stderr(stderr), timeout(timeout_):
+    cpu, wall, error = time.thread_time(), time.perf_counter(), None
+
+    with capture_output(max_output) as (stdout, stderr):
+        with timeout(timeout_):
             try:
                 exec(code, state)
 
-            except Exception as e:
-                state['__EXCEPTION__'] = type(e)
+            # e.g. `exit()`, which would end the worker process and lose the output
+            except BaseException as e:
+                state['__EXCEPTION__'], error = type(e), e
                 traceback.print_exception(type(e), e, e.__traceback__, file=stderr)
 
-        state['__STDOUT__'] = stdout.getvalue()
-        state['__STDERR__'] = stderr.getvalue()
+            # functions defined before the code failed are still graded, unless it ran out of time
+            if not isinstance(error, (ExecutionTimeout, CPUTimeExceeded)):
+                state['__CASES__'] = run_cases(cases, state)
+
+    state['__STDOUT__'] = stdout.getvalue()
+    state['__STDERR__'] = stderr.getvalue()
+    state['__TRUNCATED__'] = stdout.truncated or stderr.truncated
+    state['__USAGE__'] = dict(
+        cpu=time.thread_time() - cpu,
+        wall=time.perf_counter() - wall,
+        rss=peak_rss(),
+    )
 
     return state
 
 
-@contextmanager
-def tts(txt):
-    with NamedTemporaryFile() as f:
-        cmd = f'espeak -v de -k 5 -s 150 -w {f.name}'.split()
-        assert not subprocess.run(cmd + [txt]).returncode
+class TTSCache:
+    """
+    Content addressed on-disk cache of audio rendered by espeak, keyed by text and voice
+    parameters. Once the cache exceeds `max_bytes`, the least recently used files are removed.
+    """
+
+    def __init__(self, path='~/.das_system/tts', max_bytes=64 * 1024 ** 2, **voice):
+        self.path = os.path.expanduser(path)
+        self.max_bytes = max_bytes
+        self.voice = {**TTS_VOICE, **voice}
+        self.lock = threading.Lock()
+
+    def configure(self, path=None, max_bytes=None):
+        if path is not None:
+            self.path = os.path.expanduser(path)
+
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
+
+    def key(self, txt):
+        return hashlib.sha256(json.dumps([txt, self.voice], sort_keys=True).encode('utf-8')).hexdigest()
+
+    def render(self, txt):
+        """Returns the path of a wav file speaking `txt`, espeak only runs on a cache miss."""
+        path = os.path.join(self.path, f'{self.key(txt)}.wav')
+
+        try:
+            # the modification time tracks the last use
+            os.utime(path)
+            stats.inc('das_tts_cache_total', result='hit')
+            return path
+
+        except FileNotFoundError:
+            stats.inc('das_tts_cache_total', result='miss')
+
+        os.makedirs(self.path, exist_ok=True)
+
+        with NamedTemporaryFile(dir=self.path, suffix='.tmp', delete=False) as f:
+            tmp = f.name
+
+        try:
+            cmd = f'espeak -v {self.voice["voice"]} -k {self.voice["capitals"]} -s {self.voice["speed"]} -w {tmp}'
+            with FORK_LOCK:
+                process = subprocess.Popen(cmd.split() + [txt])
+
+            if process.wait():
+                raise subprocess.CalledProcessError(process.returncode, process.args)
+
+            os.replace(tmp, path)
+
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+        self.evict()
+        return path
+
+    def evict(self):
+        with self.lock:
+            files = []
+
+            for entry in os.scandir(self.path):
+                if entry.name.endswith('.wav'):
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, stat.st_size, entry.path))
+
+            total = sum(size for _, size, _ in files)
+
+            for _, size, path in sorted(files):
+                if total <= self.max_bytes:
+                    break
+
+                try:
+                    os.unlink(path)
+
+                except FileNotFoundError:
+                    pass
+
+                total -= size
+
+
+class TTSRenderer:
+    """
+    Renders texts via a :class:`TTSCache` on `workers` background threads. At most `maxsize`
+    texts wait for rendering, further requests fail with `queue.Full`. Requests for a text that
+    is already queued or rendered share the same future.
+    """
+
+    def __init__(self, cache, workers=2, maxsize=64):
+        self.cache = cache
+        self.workers = workers
+        self.maxsize = maxsize
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.queue = None
+
+    def configure(self, workers=None, maxsize=None):
+        with self.lock:
+            if self.queue is not None:
+                raise RuntimeError('renderer is already running')
+
+            self.workers = workers or self.workers
+            self.maxsize = maxsize or self.maxsize
+
+    def _start(self):
+        self.queue = queue.Queue(self.maxsize)
+
+        for i in range(self.workers):
+            threading.Thread(target=self._work, name=f'tts-{i}', daemon=True).start()
+
+    def _work(self):
+        while True:
+            txt, future = self.queue.get()
+
+            try:
+                with stats.timer('das_tts_seconds'):
+                    path, error = self.cache.render(txt), None
+
+            except Exception as e:
+                path, error = None, e
+
+            # later requests must not attach to a finished future, their callbacks would run
+            # on the requesting thread
+            with self.lock:
+                self.pending.pop(txt, None)
+
+            if error is None:
+                future.set_result(path)
+            else:
+                future.set_exception(error)
+
+    def depth(self):
+        return self.queue.qsize() if self.queue is not None else 0
+
+    def submit(self, txt):
+        """Returns a future of the path to the rendered audio, callbacks attached to it run on
+        the renderer threads."""
+        with self.lock:
+            if self.queue is None:
+                self._start()
+
+            future = self.pending.get(txt)
+
+            if future is None:
+                future = Future()
+
+                try:
+                    self.queue.put_nowait((txt, future))
+
+                except queue.Full as error:
+                    future.set_exception(error)
+                    return future
+
+                self.pending[txt] = future
+
+            return future
+
 
-        yield f
+tts_cache = TTSCache()
+tts_renderer = TTSRenderer(tts_cache)
@@ -0,0 +1,111 @@
+# Standard library modules.
+import json
+import hmac
+import logging
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Third party modules.
+import telegram
+
+# Local modules
+from metrics import stats
+
+# Globals and constants variables.
+system_log = logging.getLogger('das-system-log')
+
+MAX_BODY = 1024 ** 2
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _respond(self, status, headers=()):
+        self.send_response(status)
+
+        for header in headers:
+            self.send_header(*header)
+
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_POST(self):
+        server = self.server
+
+        if self.path.split('?')[0] != server.path:
+            return self._respond(404)
+
+        secret = self.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if server.secret and not hmac.compare_digest(secret, server.secret):
+            return self._respond(403)
+
+        size = int(self.headers.get('Content-Length') or 0)
+        if size > MAX_BODY:
+            self.close_connection = True
+            return self._respond(413)
+
+        try:
+            data = json.loads(self.rfile.read(size))
+
+        except ValueError:
+            return self._respond(400)
+
+        status = server.enqueue(data if isinstance(data, list) else [data])
+
+        # telegram retries a delivery that wasn't acknowledged with 2xx
+        self._respond(status, [('Retry-After', '1')] if status == 503 else ())
+
+
+class WebhookServer(ThreadingHTTPServer):
+    """
+    Receives updates posted to `path` and puts them into the `update_queue` of the dispatcher.
+    A request may carry a single update or a list of them. While more than `max_pending`
+    updates are pending, further ones are refused with `503`, so the sender retries them later.
+    `backlog()` returns the number of pending updates, those in the `update_queue` by default.
+    With a `secret`, requests have to present it as `X-Telegram-Bot-Api-Secret-Token`.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, bot, update_queue, listen='127.0.0.1', port=8443, path='/', secret=None,
+                 max_pending=1000, backlog=None):
+        super().__init__((listen, port), _Handler)
+
+        self.bot = bot
+        self.update_queue = update_queue
+        self.path = path
+        self.secret = secret
+        self.max_pending = max_pending
+        self.backlog = backlog or update_queue.qsize
+        self.lock = threading.Lock()
+
+    def enqueue(self, batch):
+        try:
+            updates = [telegram.Update.de_json(data, self.bot) for data in batch]
+
+        except Exception as error:
+            system_log.warning(f'webhook received malformed updates: {error!r}')
+            return 400
+
+        # the check and the puts must not interleave with other requests
+        with self.lock:
+            if self.backlog() + len(updates) > self.max_pending:
+                stats.inc('das_webhook_updates_total', len(updates), result='refused')
+                return 503
+
+            for update in updates:
+                self.update_queue.put(update)
+
+        stats.inc('das_webhook_updates_total', len(updates), result='accepted')
+        return 200
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name='webhook', daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()